@@ -4,8 +4,16 @@
 #
 
 
-from cogs import task, env
-from cogs.fs import exe
+from cogs import task, argument, env, invoke
+from cogs.log import log, warn, fail
+from cogs.fs import exe, sh, mktree, rmtree
+import os
+import re
+import time
+import shlex
+import resource
+import subprocess
+import yaml
 
 
 @task
@@ -36,3 +44,151 @@ def LINT():
         exe("pyflakes src/cogs")
 
 
+def _suite_titles():
+    # Titles of the regression test suites; all of them run by default.
+    try:
+        stream = open("test/input.yaml")
+    except IOError:
+        return ()
+    with stream:
+        return tuple(re.findall(r"^- title: (.*)$", stream.read(), re.M))
+
+
+@task
+class FAST_TEST(object):
+    """run regression tests in a single process
+
+    Runs the given test suites, or all of them, with `invoke()`.
+    The suites are split between `--jobs` worker processes.
+    """
+
+    suites = argument(plural=True, sharded=True, default=_suite_titles())
+
+    def __init__(self, suites):
+        self.titles = suites
+
+    def __call__(self):
+        suites = yaml.safe_load(open("test/input.yaml"))['tests']
+        records = yaml.safe_load(open("test/output.yaml"))['tests']
+        unknown = set(self.titles)-set(suite['title'] for suite in suites)
+        if unknown:
+            raise fail("unknown test suites: {}", ", ".join(sorted(unknown)))
+        passed, failed, skipped = _run_suites(
+                [suite for suite in suites if suite['title'] in self.titles],
+                [record for suite, record in zip(suites, records)
+                 if suite['title'] in self.titles])
+        log("{} passed, {} failed, {} skipped", passed, failed, skipped)
+        if failed:
+            raise fail("{} tests failed", failed)
+
+
+def _run_suites(suites, records):
+    # Runs test cases of the suites with `invoke()`; the cases are
+    # described in the PBBT format.
+    passed = failed = skipped = 0
+    for suite, record in zip(suites, records):
+        cases = suite['tests']
+        if any('sh' in case and not (isinstance(case['sh'], str) and
+                                     case['sh'].startswith("cogs "))
+               for case in cases):
+            # Only `cogs` commands could be invoked in-process.
+            log("{}: skipped", suite['title'])
+            skipped += len(cases)
+            continue
+        expected = {}
+        for item in record['tests']:
+            key = ('sh', item['sh']) if 'sh' in item else \
+                  ('read', item.get('read'))
+            expected.setdefault(key, []).append(item)
+        for case in cases:
+            if 'rm' in case:
+                os.unlink(case['rm'])
+                continue
+            if 'mkdir' in case:
+                mktree(case['mkdir'])
+                continue
+            if 'rmdir' in case:
+                if os.path.exists(case['rmdir']):
+                    rmtree(case['rmdir'])
+                continue
+            if 'write' in case:
+                with open(case['write'], 'w') as stream:
+                    stream.write(case['data'])
+                continue
+            ignore = case.get('ignore')
+            if 'read' in case:
+                label = "read %s" % case['read']
+                item = expected[('read', case['read'])].pop(0)
+                actual = open(case['read']).read()
+                wanted = item['data']
+                status = wanted_status = 0
+            else:
+                label = case['sh']
+                item = expected[('sh', case['sh'])].pop(0)
+                invocation = invoke(shlex.split(case['sh'])[1:],
+                                    cwd=case.get('cd'),
+                                    environ=case.get('environ'))
+                actual = invocation.output+invocation.errors
+                if invocation.failure is not None:
+                    # As printed by `sys.exit()`.
+                    actual += str(invocation.failure)+"\n"
+                wanted = item['stdout']
+                status = invocation.status
+                wanted_status = case.get('exit', 0)
+            if ignore:
+                actual = _mask(actual, ignore)
+                wanted = _mask(wanted, ignore)
+            if actual == wanted and status == wanted_status:
+                passed += 1
+            else:
+                failed += 1
+                log("{}: {}: FAILED", suite['title'], label)
+                log("expected (exit code {}):", wanted_status)
+                log("{}", wanted)
+                log("got (exit code {}):", status)
+                log("{}", actual)
+    return passed, failed, skipped
+
+
+def _mask(text, pattern):
+    # Removes parts of the text matching the groups of the pattern.
+    regex = re.compile(pattern.rstrip("\n"), re.X | re.M)
+    chunks = []
+    start = 0
+    for match in regex.finditer(text):
+        for group in range(1, (regex.groups or 0)+1):
+            if match.start(group) >= start:
+                chunks.append(text[start:match.start(group)])
+                start = match.end(group)
+    chunks.append(text[start:])
+    return "".join(chunks)
+
+
+@task
+def BENCH_SPAWN(count=100):
+    """measure command startup time against the process size"""
+    count = int(count)
+    if not hasattr(os, 'posix_spawn'):
+        # Python 2: `sh()` forks the process too.
+        warn("skipping the benchmark: posix_spawn() is not available")
+        return
+    ballast = []
+    log("{:<12} {:>12} {:>12}", "RSS", "fs.sh", "fork")
+    for size in [0, 256, 768, 1024]:
+        # Grow the process by the given number of MiB.
+        ballast.append(b"\x01"*(size*1024*1024))
+        # Linux reports the peak RSS in KiB.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss//1024
+        start = time.time()
+        for k in range(count):
+            sh("true")
+        sh_time = (time.time()-start)/count
+        start = time.time()
+        for k in range(count):
+            # `preexec_fn` makes `subprocess` use `fork()`.
+            subprocess.call(["true"], preexec_fn=(lambda: None))
+        fork_time = (time.time()-start)/count
+        log("{:<12} {:>10.2f}ms {:>10.2f}ms",
+            "%s MiB" % rss, sh_time*1000, fork_time*1000)
+
+
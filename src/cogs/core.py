@@ -16,7 +16,7 @@ class Failure(Exception):
 class Environment(object):
     """Container for settings and other global parameters."""
 
-    __slots__ = ('_states', '__dict__')
+    __slots__ = ('_states', '_loaders', '__dict__')
 
     class _context(object):
 
@@ -32,33 +32,68 @@ class Environment(object):
 
     def __init__(self, **updates):
         self._states = []
+        self._loaders = {}
         self.add(**updates)
 
     def clear(self):
         self.__dict__.clear()
+        self._loaders.clear()
 
     def add(self, **updates):
         for key in sorted(updates):
             assert not key.startswith('_'), \
                     "parameter should not start with '_': %r" % key
-            assert key not in self.__dict__, \
+            assert key not in self.__dict__ and key not in self._loaders, \
                     "duplicate parameter %r" % key
             self.__dict__[key] = updates[key]
 
+    def defer(self, key, loader):
+        assert not key.startswith('_'), \
+                "parameter should not start with '_': %r" % key
+        assert key not in self.__dict__ and key not in self._loaders, \
+                "duplicate parameter %r" % key
+        self._loaders[key] = loader
+
+    def remove(self, *keys):
+        for key in keys:
+            self.__dict__.pop(key, None)
+            self._loaders.pop(key, None)
+
     def set(self, **updates):
         for key in sorted(updates):
+            if key in self._loaders:
+                getattr(self, key)
             assert key in self.__dict__, \
                     "unknown parameter %r" % key
             self.__dict__[key] = updates[key]
 
     def push(self, **updates):
-        self._states.append(self.__dict__)
+        self._states.append((self.__dict__, self._loaders))
         self.__dict__ = self.__dict__.copy()
+        self._loaders = self._loaders.copy()
         self.set(**updates)
 
     def pop(self):
         assert self._states, "unbalanced pop()"
-        self.__dict__ = self._states.pop()
+        self.__dict__, self._loaders = self._states.pop()
+
+    def __getattr__(self, key):
+        # Only called when the parameter is not set; if it is deferred,
+        # initialize it now.
+        if key.startswith('_') or key not in self._loaders:
+            raise AttributeError(key)
+        loader = self._loaders.pop(key)
+        keys = set(self.__dict__)
+        loader()
+        if key not in self.__dict__:
+            raise AttributeError(key)
+        # Saved states waiting for the same loader get the value too.
+        for state, loaders in self._states:
+            if loaders.get(key) is loader:
+                del loaders[key]
+                for new_key in set(self.__dict__)-keys:
+                    state.setdefault(new_key, self.__dict__[new_key])
+        return self.__dict__[key]
 
     def __call__(self, **updates):
         return self._context(self, **updates)
@@ -68,11 +103,12 @@ class TaskSpec(object):
     """Task specification."""
 
     def __init__(self, name, code, args, opts,
-                 hint=None, help=None):
+                 lock=None, hint=None, help=None):
         self.name = name
         self.code = code
         self.args = args
         self.opts = opts
+        self.lock = lock
         self.hint = hint
         self.help = help
         self.opt_by_name = {}
@@ -87,11 +123,13 @@ class SettingSpec(object):
     """Setting specification."""
 
     def __init__(self, name, code, has_value=False, value_name=None,
-                 hint=None, help=None):
+                 is_lazy=False, hint=None, help=None):
         self.name = name
         self.code = code
+        self.attr = name.replace('-', '_')
         self.has_value = has_value
         self.value_name = value_name
+        self.is_lazy = is_lazy
         self.hint = hint
         self.help = help
 
@@ -110,33 +148,43 @@ class ArgSpec(object):
     """Task argument specification."""
 
     def __init__(self, attr, name, check, default,
-                 is_optional=False, is_plural=False):
+                 is_optional=False, is_plural=False, is_sharded=False,
+                 is_batch=False):
         self.attr = attr
         self.name = name
         self.check = check
         self.default = default
         self.is_optional = is_optional
         self.is_plural = is_plural
+        self.is_sharded = is_sharded
+        self.is_batch = is_batch
 
 
 class OptSpec(object):
     """Task option specification."""
 
     def __init__(self, attr, name, key, check, default,
-                 is_plural=False, has_value=False, value_name=None, hint=None):
+                 is_plural=False, has_value=False, value_name=None, hint=None,
+                 is_batch=False):
         self.attr = attr
         self.name = name
         self.key = key
         self.check = check
         self.default = default
         self.is_plural = is_plural
+        self.is_batch = is_batch
         self.has_value = has_value
         self.value_name = value_name
         self.hint = hint
 
 
-def task(T, is_default=False):
+def task(T=None, is_default=False, lock=None):
     """Registers the wrapped function/class as a task."""
+    # Used as `@task(lock=...)`.
+    if T is None:
+        return lambda T: task(T, is_default, lock)
+    assert lock in [None, 'wait', 'fail'], \
+            "lock must be one of 'wait', 'fail': %r" % lock
     assert isinstance(T, (types.ClassType,
                           types.TypeType,
                           types.FunctionType)), \
@@ -204,12 +252,15 @@ def task(T, is_default=False):
         check = dsc.check
         default = dsc.default
         is_plural = dsc.plural
+        is_sharded = dsc.sharded
+        is_batch = dsc.batch
         is_optional = True
         if default is dsc.REQ:
             is_optional = False
             default = None
         spec = ArgSpec(attr, name, check, default=default,
-                       is_optional=is_optional, is_plural=is_plural)
+                       is_optional=is_optional, is_plural=is_plural,
+                       is_sharded=is_sharded, is_batch=is_batch)
         args.append(spec)
     for order, attr, dsc in opt_attrs:
         name = _to_name(attr)
@@ -231,8 +282,10 @@ def task(T, is_default=False):
             value_name = None
             default = False
         hint = dsc.hint
+        is_batch = dsc.batch
         spec = OptSpec(attr, name, key, check, default, is_plural=is_plural,
-                       has_value=has_value, value_name=value_name, hint=hint)
+                       has_value=has_value, value_name=value_name, hint=hint,
+                       is_batch=is_batch)
         opts.append(spec)
 
     # Extract the name and description.
@@ -242,7 +295,8 @@ def task(T, is_default=False):
     hint, help = _describe(norm_T)
 
     # Register the task.
-    spec = TaskSpec(name, norm_T, args, opts, hint=hint, help=help)
+    spec = TaskSpec(name, norm_T, args, opts, lock=lock,
+                    hint=hint, help=help)
     env.task_map[name] = spec
     return T
 
@@ -252,7 +306,7 @@ def default_task(T):
     return task(T, True)
 
 
-def setting(S):
+def setting(S, is_lazy=False):
     """Registers the wrapped function as a setting."""
     assert isinstance(S, types.FunctionType), \
             "a setting must be a function"
@@ -270,11 +324,16 @@ def setting(S):
 
     # Register the setting.
     spec = SettingSpec(name, S, has_value=has_value, value_name=value_name,
-                       hint=hint, help=help)
+                       is_lazy=is_lazy, hint=hint, help=help)
     env.setting_map[name] = spec
     return S
 
 
+def lazy_setting(S):
+    """Registers the wrapped function as a setting initialized on demand."""
+    return setting(S, True)
+
+
 def topic(T):
     """Registers the wrapped function as a help topic."""
     assert isinstance(T, types.FunctionType), \
@@ -301,11 +360,19 @@ class argument(object):
     CTR = itertools.count(1)
     REQ = object()
 
-    def __init__(self, check=None, default=REQ, plural=False):
+    def __init__(self, check=None, default=REQ, plural=False, sharded=False,
+                 batch=False):
         assert isinstance(plural, bool)
+        assert isinstance(sharded, bool)
+        assert isinstance(batch, bool)
+        assert plural or not sharded, "only a plural argument can be sharded"
+        assert plural or not batch, \
+                "only a plural argument can be checked in a batch"
         self.check = check
         self.default = default
         self.plural = plural
+        self.sharded = sharded
+        self.batch = batch
         self.order = next(self.CTR)
 
     def __get__(self, instance, owner):
@@ -321,11 +388,14 @@ class option(object):
     NOVAL = object()
 
     def __init__(self, key=None, check=None, default=NOVAL, plural=False,
-                 value_name=None, hint=None):
+                 value_name=None, hint=None, batch=False):
         assert key is None or (isinstance(key, str) and
                                re.match(r'^[a-zA-Z]$', key)), \
                 "key must be a letter, got %r" % key
         assert isinstance(plural, bool)
+        assert isinstance(batch, bool)
+        assert plural or not batch, \
+                "only a plural option can be checked in a batch"
         assert value_name is None or isinstance(value_name, str)
         assert hint is None or isinstance(hint, str)
         self.key = key
@@ -334,9 +404,20 @@ class option(object):
         self.plural = plural
         self.value_name = value_name
         self.hint = hint
+        self.batch = batch
         self.order = next(self.CTR)
 
 
+def _exit_status(result):
+    # Convert the value returned by a task to the exit code of the
+    # process, as `sys.exit()` does.
+    if result is None:
+        return 0
+    if isinstance(result, (int, long)):
+        return int(result)
+    return 1
+
+
 def _to_name(keyword):
     # Convert an identifier or a keyword to a task/setting name.
     return keyword.lower().replace(' ', '-').replace('_', '-')
@@ -402,6 +483,7 @@ cogs.env = env
 cogs.task = task
 cogs.default_task = default_task
 cogs.setting = setting
+cogs.lazy_setting = lazy_setting
 cogs.topic = topic
 cogs.argument = argument
 cogs.option = option
@@ -5,30 +5,86 @@
 
 
 from .core import env
-from .log import debug, fail
+from .log import debug, warn, fail, progress
+from .prof import _format_size
+from .run import _export_settings, _remove_settings
 import sys
 import os
+import io
+import stat
+import errno
+import fcntl
+import re
+import time
+import math
+import signal
+import resource
+import threading
+import fnmatch
+import select
+import struct
+import json
+import mmap
+import hashlib
+import tempfile
 import shutil
+import itertools
+import collections
+import zlib
+import tarfile
+import zipfile
+import Queue
 import shlex
+import binascii
 import subprocess
+import multiprocessing
+import multiprocessing.pool
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+try:
+    # Python 3.3+.
+    from shlex import quote as _quote
+except ImportError:
+    # Python 2.
+    from pipes import quote as _quote
+try:
+    # Python 3.3+.
+    import lzma
+except ImportError:
+    # Python 2.
+    lzma = None
+
+
+def read(path):
+    """Map the content of a file to memory."""
+    stream = open(path, 'rb')
+    try:
+        if os.fstat(stream.fileno()).st_size == 0:
+            # Empty files cannot be mapped.
+            return _EmptyMap()
+        return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        stream.close()
+
+
+def write(path, data=None, durability='data'):
+    """Replace the content of a file atomically."""
+    assert durability in ['none', 'data', 'full'], \
+            "durability must be one of 'none', 'data', 'full': %r" \
+            % durability
+    stream = _AtomicFile(path, durability)
+    if data is None:
+        return stream
+    with stream:
+        stream.write(data)
 
 
 def cp(src_path, dst_path):
     """Copy a file or a directory."""
     debug("cp {} {}", src_path, dst_path)
-    if os.path.isfile(src_path):
-        shutil.copy2(src_path, dst_path)
-    elif os.path.islink(src_path):
-        link = os.readlink(src_path)
-        os.symlink(link, dst_path)
-    else:
-        if os.path.exists(dst_path):
-            dst_path = os.path.join(dst_path, os.path.basename(src_path))
-        os.mkdir(dst_path)
-        for filename in os.listdir(src_path):
-            with env(debug=False):
-                cp(os.path.join(src_path, filename),
-                   os.path.join(dst_path, filename))
+    _cp(src_path, dst_path)
 
 
 def mv(src_path, dst_path):
@@ -56,11 +112,31 @@ def mktree(path):
         os.makedirs(path)
 
 
-def exe(cmd, cd=None, environ=None):
+def exe(cmd, cd=None, environ=None,
+        timeout=None, cpu_limit=None, mem_limit=None, nice=None):
     """Execute the command replacing the current process."""
     debug("{}", cmd)
+    limits = _limits(timeout=timeout, cpu_limit=cpu_limit,
+                     mem_limit=mem_limit, nice=nice)
     if isinstance(cmd, str):
         cmd = shlex.split(cmd)
+    if limits['timeout'] is not None:
+        # Nobody is left to enforce the timeout after `exec()`, so the
+        # command runs in its own process group, as with `sh()`.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        proc = _popen(cmd, None, None, None, cd, environ, limits)
+        try:
+            _communicate(proc, _cmd_text(cmd), None, limits)
+        finally:
+            _remove_settings()
+        if hasattr(sys, 'exitfunc'):
+            sys.exitfunc()
+        if proc.returncode < 0:
+            os._exit(128-proc.returncode)
+        os._exit(proc.returncode)
+    # Nobody is going to remove the saved settings after `exec()`.
+    _remove_settings()
     if environ:
         overrides = environ
         environ = os.environ.copy()
@@ -70,57 +146,2275 @@ def exe(cmd, cd=None, environ=None):
     if hasattr(sys, 'exitfunc'):
         sys.exitfunc()
     try:
+        _apply_limits(limits)
         if environ:
             os.execvpe(cmd[0], cmd, environ)
         else:
             os.execvp(cmd[0], cmd)
-    except OSError, exc:
+    except (OSError, ValueError), exc:
         raise fail(str(exc))
 
 
-def sh(cmd, data=None, cd=None, environ=None):
+def sh(cmd, data=None, cd=None, environ=None,
+       timeout=None, cpu_limit=None, mem_limit=None, nice=None):
     """Execute a command using shell."""
+    argv = cmd
+    cmd = _cmd_text(cmd)
     if cd is None:
         debug("{}", cmd)
     else:
         debug("cd {}; {}", cd, cmd)
+    limits = _limits(timeout=timeout, cpu_limit=cpu_limit,
+                     mem_limit=mem_limit, nice=nice)
     stream = subprocess.PIPE
     if env.debug:
         stream = None
-    if environ:
-        overrides = environ
-        environ = os.environ.copy()
-        environ.update(overrides)
-    proc = subprocess.Popen(cmd, shell=True, stdin=stream,
-                            stdout=stream, stderr=stream,
-                            cwd=cd, env=environ)
-    proc.communicate(data)
+    proc = _popen(argv, stream, stream, stream, cd, environ, limits)
+    _communicate(proc, cmd, data, limits)
     if proc.returncode != 0:
-        raise fail("`{}`: non-zero exit code", cmd)
+        raise _failure(cmd, proc.returncode)
 
 
-def pipe(cmd, data=None, cd=None, environ=None):
+def pipe(cmd, data=None, cd=None, environ=None,
+         timeout=None, cpu_limit=None, mem_limit=None, nice=None):
     """Execute the command, return the output."""
+    argv = cmd
+    cmd = _cmd_text(cmd)
     if cd is None:
         debug("| {}", cmd)
     else:
         debug("$ cd {}; | {}", cd, cmd)
+    limits = _limits(timeout=timeout, cpu_limit=cpu_limit,
+                     mem_limit=mem_limit, nice=nice)
     stream = subprocess.PIPE
-    if environ:
-        overrides = environ
-        environ = os.environ.copy()
-        environ.update(overrides)
-    proc = subprocess.Popen(cmd, shell=True,
-                            stdout=stream, stderr=stream,
-                            cwd=cd, env=environ)
-    out, err = proc.communicate(data)
+    stdin = None
+    if data is not None:
+        stdin = stream
+    proc = _popen(argv, stdin, stream, stream, cd, environ, limits)
+    out, err = _communicate(proc, cmd, data, limits)
     if proc.returncode != 0:
         if env.debug:
             if out:
                 sys.stdout.write(out)
             if err:
                 sys.stderr.write(err)
-        raise fail("`{}`: non-zero exit code", cmd)
+        raise _failure(cmd, proc.returncode)
+    return out
+
+
+def stage(cmd, cd=None, environ=None):
+    """Describe a pipeline stage."""
+    return _Stage(cmd, cd, environ)
+
+
+def pipeline(stages, data=None, output=None, stream=False, timeout=None):
+    """Execute commands connected with pipes, return the output."""
+    stages = [item if isinstance(item, _Stage) else _Stage(item, None, None)
+              for item in stages]
+    debug("| {}", " | ".join(_cmd_text(item.cmd) if item.cd is None
+                             else "(cd %s; %s)"
+                                  % (item.cd, _cmd_text(item.cmd))
+                             for item in stages))
+    if output is not None:
+        debug("> {}", output)
+        if stream:
+            raise fail("cannot stream the output written to {}", output)
+    pipeline = _Pipeline(stages, data, output, timeout)
+    if stream:
+        return pipeline.iterate()
+    out = None
+    try:
+        if pipeline.stdout is not None:
+            out = pipeline.stdout.read()
+    except BaseException:
+        pipeline.kill()
+        raise
+    pipeline.wait()
     return out
 
 
+class session(object):
+    """Executes shell commands in a long-running shell process."""
+
+    def __init__(self, shell='/bin/sh'):
+        self.shell = shell
+        self.proc = None
+        self.marker = b"--cogs-"+binascii.hexlify(os.urandom(8))+b"-- "
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def sh(self, cmd, data=None, cd=None, environ=None):
+        """Execute a command using the shell."""
+        if cd is None:
+            debug("{}", cmd)
+        else:
+            debug("cd {}; {}", cd, cmd)
+        returncode, out, err = self.run(cmd, data, cd, environ)
+        if env.debug:
+            self.echo(out, err)
+        if returncode != 0:
+            raise _failure(cmd, returncode)
+
+    def pipe(self, cmd, data=None, cd=None, environ=None):
+        """Execute the command, return the output."""
+        if cd is None:
+            debug("| {}", cmd)
+        else:
+            debug("$ cd {}; | {}", cd, cmd)
+        returncode, out, err = self.run(cmd, data, cd, environ)
+        if returncode != 0:
+            if env.debug:
+                self.echo(out, err)
+            raise _failure(cmd, returncode)
+        return out
+
+    def run(self, cmd, data=None, cd=None, environ=None):
+        """Execute the command, return the exit code and the output."""
+        # Each command runs in a subshell so that it could not change
+        # the state of the session.
+        cd = os.path.join(os.getcwd(), cd or '')
+        script = "cd %s" % _quote(cd)
+        for key in sorted(environ or {}):
+            script += " && export %s=%s" % (key, _quote(environ[key]))
+        script += " && eval %s" % _quote(cmd)
+        data_path = None
+        if data is not None:
+            fd, data_path = tempfile.mkstemp(prefix='cogs-')
+            os.write(fd, data)
+            os.close(fd)
+        script = ("( %s\n) < %s\n"
+                  "printf '%%s%%d\\n' %s \"$?\"\n"
+                  "printf '%%s\\n' %s >&2\n"
+                  % (script, _quote(data_path or os.devnull),
+                     _quote(self.marker.decode('ascii')),
+                     _quote(self.marker.decode('ascii'))))
+        try:
+            for attempt in range(2):
+                if self.proc is None or self.proc.poll() is not None:
+                    self.start()
+                try:
+                    self.proc.stdin.write(_to_bytes(script))
+                    self.proc.stdin.flush()
+                    break
+                except (IOError, OSError):
+                    # The shell is dead; restart it.
+                    self.stop()
+            else:
+                raise fail("`{}`: cannot start {}", cmd, self.shell)
+            return self.read(cmd)
+        except BaseException:
+            self.stop()
+            raise
+        finally:
+            if data_path is not None:
+                os.unlink(data_path)
+
+    def close(self):
+        """Stop the shell."""
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.wait()
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+            self.proc = None
+
+    def start(self):
+        self.stop()
+        _export_settings()
+        self.proc = subprocess.Popen([self.shell], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+
+    def stop(self):
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.kill()
+            self.close()
+
+    def read(self, cmd):
+        # Read the output of the command up to the markers.
+        fds = [self.proc.stdout.fileno(), self.proc.stderr.fileno()]
+        buffers = dict((fd, bytearray()) for fd in fds)
+        ends = {}
+        done = set()
+        while len(done) < len(fds):
+            ready = select.select([fd for fd in fds if fd not in done],
+                                  [], [])[0]
+            for fd in ready:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    self.stop()
+                    raise fail("`{}`: shell session terminated", cmd)
+                buffer = buffers[fd]
+                start = max(0, len(buffer)-len(self.marker))
+                buffer += chunk
+                if fd not in ends:
+                    index = buffer.find(self.marker, start)
+                    if index != -1:
+                        ends[fd] = index
+                if fd in ends and buffer.endswith(b"\n"):
+                    done.add(fd)
+        out_fd, err_fd = fds
+        out = bytes(buffers[out_fd][:ends[out_fd]])
+        err = bytes(buffers[err_fd][:ends[err_fd]])
+        returncode = int(buffers[out_fd][ends[out_fd]+len(self.marker):])
+        return returncode, out, err
+
+    def echo(self, out, err):
+        # Display the output of the command.
+        for stream, data in [(sys.stdout, out), (sys.stderr, err)]:
+            if data:
+                stream = getattr(stream, 'buffer', stream)
+                stream.write(data)
+                stream.flush()
+
+
+class plan(object):
+    """Records file operations to execute them in parallel."""
+
+    def __init__(self, dry_run=False, jobs=None):
+        self.dry_run = dry_run
+        self.jobs = jobs
+        self.ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.run()
+
+    def cp(self, src_path, dst_path):
+        """Copy a file or a directory."""
+        dst_path = os.path.abspath(dst_path)
+        self.add(_PlanOp('cp', os.path.abspath(src_path), dst_path,
+                         writes=[dst_path],
+                         reads=[os.path.abspath(src_path)],
+                         needs=[os.path.dirname(dst_path)]))
+
+    def mv(self, src_path, dst_path):
+        """Rename a file."""
+        src_path = os.path.abspath(src_path)
+        dst_path = os.path.abspath(dst_path)
+        self.add(_PlanOp('mv', src_path, dst_path,
+                         writes=[src_path, dst_path],
+                         needs=[os.path.dirname(dst_path)]))
+
+    def rm(self, path):
+        """Remove a file."""
+        path = os.path.abspath(path)
+        self.add(_PlanOp('rm', path, writes=[path]))
+
+    def rmtree(self, path):
+        """Remove a directory tree."""
+        path = os.path.abspath(path)
+        self.add(_PlanOp('rmtree', path, writes=[path]))
+
+    def mktree(self, path):
+        """Create a directory tree."""
+        path = os.path.abspath(path)
+        # Merge with an earlier `mktree()` unless the directories were
+        # modified since.
+        for op in reversed(self.ops):
+            if op.kind == 'mktree' and _is_related(op.path, path):
+                if len(path) > len(op.path):
+                    op.path = path
+                return
+            if any(_is_related(other, path)
+                   for other in op.writes+op.reads):
+                break
+        self.add(_PlanOp('mktree', path))
+
+    def add(self, op):
+        self.ops.append(op)
+
+    def levels(self):
+        """Groups operations; each group depends only on the previous."""
+        # Find the earlier operations each operation must wait for.
+        index = _PlanIndex()
+        followers = [[] for op in self.ops]
+        degrees = []
+        for idx, op in enumerate(self.ops):
+            if op.kind == 'mktree':
+                # Directories created by `mktree()`.
+                root = op.path
+                while not os.path.exists(os.path.dirname(root)):
+                    root = os.path.dirname(root)
+                op.writes = [root]
+            deps = index.conflicts(op)
+            for dep in deps:
+                followers[dep].append(idx)
+            degrees.append(len(deps))
+            index.add(idx, op)
+        # Sort topologically; a level holds the operations whose
+        # dependencies are all in the previous levels.
+        levels = []
+        ready = [idx for idx, degree in enumerate(degrees) if not degree]
+        while ready:
+            for idx in ready:
+                self.ops[idx].level = len(levels)
+            levels.append([self.ops[idx] for idx in ready])
+            next_ready = []
+            for idx in ready:
+                for follower in followers[idx]:
+                    degrees[follower] -= 1
+                    if not degrees[follower]:
+                        next_ready.append(follower)
+            ready = sorted(next_ready)
+        return levels
+
+    def run(self):
+        """Executes the recorded operations."""
+        levels = self.levels()
+        count = len(self.ops)
+        self.ops = []
+        if not levels:
+            return
+        debug("plan of {} operations in {} steps{}",
+              count, len(levels), " (dry run)" if self.dry_run else "")
+        if self.dry_run:
+            for idx, level in enumerate(levels):
+                for op in level:
+                    debug("{}: {}", idx+1, op)
+            return
+        # Replaced files are renamed to `.<name>.<token>-<N>~`.
+        token = binascii.hexlify(os.urandom(4)).decode('ascii')
+        counter = itertools.count()
+        def backup():
+            return "%s-%s" % (token, next(counter))
+        # Plans of processes that died are rolled back first.
+        _recover_plans()
+        journal = _PlanJournal(token)
+        undo = []
+        errors = []
+        lock = threading.Lock()
+        def work(op):
+            actions = []
+            def record(action):
+                # Saved before the step is made.
+                journal.record(action)
+                actions.append(action)
+            try:
+                op.execute(record, backup)
+            except Exception:
+                with lock:
+                    errors.append((op, sys.exc_info()))
+            finally:
+                with lock:
+                    undo.append(actions)
+        pool = multiprocessing.pool.ThreadPool(_jobs(self.jobs))
+        try:
+            for level in levels:
+                # Workers do not touch `env`, which is not thread-safe.
+                for op in level:
+                    debug("{}", op)
+                pool.map(work, level)
+                if errors:
+                    break
+            if errors:
+                op, exc_info = errors[0]
+                debug("rolling back {} operations", len(undo))
+                for actions in reversed(undo):
+                    for action in reversed(actions):
+                        _undo(action)
+                journal.close()
+                if isinstance(exc_info[1], (IOError, OSError)):
+                    raise fail("cannot {}: {}", op, exc_info[1])
+                raise exc_info[1], None, exc_info[2]
+            # Commit: remove the replaced files.
+            journal.record(('commit',))
+            backups = [action[1] for actions in undo for action in actions
+                       if action[0] == 'backup']
+            pool.map(_remove_tree, backups)
+            journal.close()
+        finally:
+            pool.close()
+            pool.join()
+
+
+class scratch(object):
+    """Temporary workspace, in memory if possible."""
+
+    # Without a budget, memory is used if that much is available.
+    MIN_FREE = 256*1024*1024
+
+    def __init__(self, budget=None, prefix='cogs-'):
+        self.budget = budget
+        self.prefix = prefix
+        self.root = None
+        self.is_owner = False
+        self.is_memory = False
+        self.pid = None
+
+    def __enter__(self):
+        outer = env.scratch
+        if outer is not None:
+            # Nested tasks share the workspace.
+            self.root = outer.root
+            self.is_memory = outer.is_memory
+            if self.budget is None:
+                self.budget = outer.budget
+            env.push(scratch=outer)
+            return self
+        base_dir = None
+        for path in ['/dev/shm', os.environ.get('XDG_RUNTIME_DIR')]:
+            if path and _memory_free(path) >= (self.budget or self.MIN_FREE):
+                base_dir = path
+                self.is_memory = True
+                break
+        self.root = tempfile.mkdtemp(prefix=self.prefix, dir=base_dir)
+        self.is_owner = True
+        self.pid = os.getpid()
+        debug("scratch {}", self.root)
+        self.handler = None
+        if threading.current_thread().name == 'MainThread':
+            self.handler = signal.signal(signal.SIGTERM, self.terminate)
+        env.push(scratch=self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        env.pop()
+        if not self.is_owner:
+            return
+        if self.handler is not None:
+            signal.signal(signal.SIGTERM, self.handler)
+        if exc_type is None and self.budget is not None:
+            usage = self.usage()
+            if usage > self.budget:
+                warn("scratch {} used {} over the budget of {}", self.root,
+                     _format_size(usage), _format_size(self.budget))
+        self.remove()
+
+    def join(self, *names):
+        """Makes a path in the workspace."""
+        return os.path.join(self.root, *names)
+
+    def usage(self):
+        """Disk or memory used by the workspace, in bytes."""
+        total = 0
+        for name, entry in _walk(self.root):
+            st = entry.stat(follow_symlinks=False)
+            total += getattr(st, 'st_blocks', 0)*512 or st.st_size
+        return total
+
+    def check(self):
+        """Fails if the workspace is over the budget."""
+        if self.budget is None:
+            return
+        usage = self.usage()
+        if usage > self.budget:
+            raise fail("scratch {} uses {} over the budget of {}",
+                       self.root, _format_size(usage),
+                       _format_size(self.budget))
+
+    def remove(self):
+        # Only the process that created the workspace removes it.
+        if self.root is not None and os.getpid() == self.pid:
+            debug("rmtree {}", self.root)
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.pid = None
+
+    def terminate(self, signo, frame):
+        # On `SIGTERM`, remove the workspace and let the signal proceed.
+        self.remove()
+        handler = self.handler
+        if callable(handler):
+            return handler(signo, frame)
+        signal.signal(signal.SIGTERM, handler or signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+
+def cpu_count():
+    """Number of CPUs available to the process."""
+    try:
+        # Python 3.3+.
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Python 2.
+        count = multiprocessing.cpu_count()
+    quota = _cpu_quota()
+    if quota is not None:
+        count = min(count, quota)
+    return max(count, 1)
+
+
+def watch(paths, delay=0.2, interval=1.0):
+    """Wait for changes in the given files; yield lists of changed paths."""
+    patterns = [os.path.normpath(path) for path in paths]
+    roots = sorted(set(_glob_root(pattern) for pattern in patterns))
+    try:
+        watcher = _Inotify(roots)
+    except (OSError, AttributeError), exc:
+        debug("cannot use inotify: {}; polling for changes", exc)
+        watcher = _Poll(roots, interval)
+    try:
+        while True:
+            # Wait for the first relevant event.
+            changes = set()
+            while not changes:
+                changes.update(os.path.normpath(path)
+                               for path in watcher.read(None)
+                               if _match(path, patterns))
+            # Collect the rest of the burst.
+            while True:
+                batch = watcher.read(delay)
+                if not batch:
+                    break
+                changes.update(os.path.normpath(path) for path in batch
+                               if _match(path, patterns))
+            yield sorted(changes)
+    finally:
+        watcher.close()
+
+
+def digest(path, algorithm='sha256', cache=True, jobs=None):
+    """Calculate the digest of a directory tree."""
+    debug("digest {}", path)
+    root = os.path.abspath(path)
+    # Find all files and directories.
+    entries = []
+    if os.path.isdir(root):
+        queue = [(root, '')]
+        while queue:
+            dir_path, dir_name = queue.pop()
+            dir_entries = sorted(_entries(dir_path),
+                                 key=(lambda entry: entry.name))
+            if not dir_entries and dir_name:
+                entries.append((dir_name, 'dir', None))
+            for entry in reversed(dir_entries):
+                name = dir_name+entry.name
+                if entry.is_symlink():
+                    entries.append((name, 'link', entry))
+                elif entry.is_dir():
+                    queue.append((entry.path, name+'/'))
+                elif entry.is_file():
+                    entries.append((name, 'file', entry))
+                else:
+                    # Reading a FIFO or a device may never end.
+                    debug("skipping {}: not a regular file", entry.path)
+    else:
+        if not os.path.isfile(root):
+            raise fail("cannot digest {}: not a regular file", path)
+        entries.append((os.path.basename(root), 'file',
+                        _DirEntry(os.path.dirname(root),
+                                  os.path.basename(root))))
+    entries.sort()
+    # Find file digests, reusing those saved in the cache; each tree
+    # has its own cache file.
+    cache_path = None
+    saved = {}
+    if cache:
+        cache_path = os.path.join(
+                env.shell.cache_dir, 'digests', "%s-%s.json"
+                % (algorithm, hashlib.sha1(_to_bytes(root)).hexdigest()))
+        try:
+            saved = json.load(open(cache_path))
+        except (IOError, ValueError):
+            pass
+    manifest = {}
+    keys = {}
+    pending = []
+    for name, kind, entry in entries:
+        if kind == 'dir':
+            manifest[name] = None
+        elif kind == 'link':
+            manifest[name] = hashlib.new(
+                    algorithm, _to_bytes(os.readlink(entry.path))).hexdigest()
+        else:
+            st = entry.stat()
+            key = [st.st_ino, st.st_size, _mtime_ns(st)]
+            keys[name] = key
+            record = saved.get(_cache_key(entry.path))
+            if record is not None and record[:3] == key:
+                # JSON gives back a unicode string; keep it from mixing
+                # with file names which may not be ASCII.
+                manifest[name] = str(record[3])
+            else:
+                pending.append((name, entry.path, st.st_size))
+    if pending:
+        pool = multiprocessing.pool.ThreadPool(_jobs(jobs))
+        try:
+            digests = pool.map(lambda item: _hash_file(item[1], item[2],
+                                                       algorithm),
+                               pending)
+        finally:
+            pool.close()
+            pool.join()
+        for (name, file_path, size), file_digest in zip(pending, digests):
+            manifest[name] = file_digest
+    if cache_path is not None and (pending or len(saved) != len(keys)):
+        # Forget files that are gone; remember the new digests.
+        saved = dict((_cache_key(entry.path), keys[name]+[manifest[name]])
+                     for name, kind, entry in entries if kind == 'file')
+        try:
+            _save_json(cache_path, saved)
+        except (IOError, OSError), exc:
+            debug("cannot save digest cache {}: {}", cache_path, exc)
+    # Combine digests of all entries.
+    tree = hashlib.new(algorithm)
+    for name, kind, entry in entries:
+        tree.update(_to_bytes("%s\0%s\0%s\n"
+                              % (kind, name, manifest[name] or '')))
+    return tree.hexdigest(), manifest
+
+
+def sync(src_path, dst_path, checksum=False, delete=False, jobs=None):
+    """Synchronize the destination tree with the source tree."""
+    debug("sync {} {}", src_path, dst_path)
+    stats = {'copied': 0, 'deleted': 0, 'unchanged': 0, 'bytes': 0}
+    lock = threading.Lock()
+    errors = []
+    jobs = _jobs(jobs)
+    # Files are copied by a pool of threads; the queue is bounded so
+    # that the memory use does not depend on the size of the tree.
+    pending = Queue.Queue(maxsize=jobs*16)
+    # Statistics and errors are shared with the worker threads.
+    def count(key, value=1):
+        with lock:
+            stats[key] += value
+    def work():
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            src_file, dst_file, size, compare = item
+            try:
+                if compare and (_hash_file(src_file, size, 'sha256') ==
+                                _hash_file(dst_file, size, 'sha256')):
+                    count('unchanged')
+                    continue
+                _replace_file(src_file, dst_file)
+                count('copied')
+                count('bytes', size)
+            except (IOError, OSError), exc:
+                with lock:
+                    errors.append(exc)
+    workers = []
+    for k in range(jobs):
+        worker = threading.Thread(target=work)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    try:
+        if os.path.isdir(src_path):
+            # Visit one directory at a time.
+            dirs = [(src_path, dst_path)]
+            while dirs and not errors:
+                src_dir, dst_dir = dirs.pop()
+                if os.path.islink(dst_dir) or \
+                        (os.path.exists(dst_dir) and
+                         not os.path.isdir(dst_dir)):
+                    os.unlink(dst_dir)
+                if not os.path.isdir(dst_dir):
+                    os.mkdir(dst_dir)
+                    shutil.copymode(src_dir, dst_dir)
+                dst_entries = dict((entry.name, entry)
+                                   for entry in _entries(dst_dir))
+                for src_entry in sorted(_entries(src_dir),
+                                        key=(lambda entry: entry.name),
+                                        reverse=True):
+                    dst_entry = dst_entries.pop(src_entry.name, None)
+                    dst_file = os.path.join(dst_dir, src_entry.name)
+                    if src_entry.is_dir() and not src_entry.is_symlink():
+                        dirs.append((src_entry.path, dst_file))
+                        continue
+                    if dst_entry is not None and \
+                            dst_entry.is_dir() and not dst_entry.is_symlink():
+                        shutil.rmtree(dst_file)
+                        dst_entry = None
+                    if src_entry.is_symlink():
+                        link = os.readlink(src_entry.path)
+                        if dst_entry is not None and \
+                                dst_entry.is_symlink() and \
+                                os.readlink(dst_file) == link:
+                            count('unchanged')
+                            continue
+                        if dst_entry is not None:
+                            os.unlink(dst_file)
+                        os.symlink(link, dst_file)
+                        count('copied')
+                        continue
+                    src_st = src_entry.stat()
+                    if not stat.S_ISREG(src_st.st_mode):
+                        # Reading a FIFO or a device may never end.
+                        debug("skipping {}: not a regular file",
+                              src_entry.path)
+                        continue
+                    item = _sync_item(src_entry.path, src_st,
+                                      dst_file,
+                                      dst_entry.stat(follow_symlinks=False)
+                                      if dst_entry is not None else None,
+                                      checksum)
+                    if item is None:
+                        count('unchanged')
+                    else:
+                        pending.put(item)
+                if delete:
+                    for dst_entry in dst_entries.values():
+                        if dst_entry.is_dir() and \
+                                not dst_entry.is_symlink():
+                            shutil.rmtree(dst_entry.path)
+                        else:
+                            os.unlink(dst_entry.path)
+                        count('deleted')
+        else:
+            if os.path.isdir(dst_path):
+                dst_path = os.path.join(dst_path,
+                                        os.path.basename(src_path))
+            dst_st = None
+            if os.path.lexists(dst_path):
+                dst_st = os.lstat(dst_path)
+                if stat.S_ISDIR(dst_st.st_mode):
+                    shutil.rmtree(dst_path)
+            src_st = os.stat(src_path)
+            if not stat.S_ISREG(src_st.st_mode):
+                raise fail("cannot sync {}: not a regular file", src_path)
+            item = _sync_item(src_path, src_st, dst_path, dst_st, checksum)
+            if item is None:
+                count('unchanged')
+            else:
+                pending.put(item)
+    except (IOError, OSError), exc:
+        with lock:
+            errors.append(exc)
+    finally:
+        for worker in workers:
+            pending.put(None)
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise fail("cannot sync {} to {}: {}", src_path, dst_path, errors[0])
+    debug("copied {copied} files ({bytes} bytes),"
+          " deleted {deleted}, unchanged {unchanged}", **stats)
+    return stats
+
+
+def pack(src_path, archive, jobs=None, quiet=False):
+    """Pack the content of a directory to an archive."""
+    debug("pack {} {}", src_path, archive)
+    format = _archive_format(archive)
+    with progress("Packing %s" % archive) if not quiet else _NoProgress() \
+            as counter:
+        # The archive appears only when it is complete.
+        output = _AtomicFile(archive, 'none')
+        if format == 'zip':
+            with output:
+                stream = zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED,
+                                         allowZip64=True)
+                for name, entry in _archive_entries(src_path):
+                    _zip_add(stream, name, entry)
+                    counter.update()
+                stream.close()
+            return
+        with output:
+            if format == 'gz':
+                writer = _BlockWriter(output, _gzip_block,
+                                      1024*1024, _jobs(jobs))
+            else:
+                writer = _BlockWriter(output, _xz_block,
+                                      8*1024*1024, _jobs(jobs))
+            try:
+                # The archive is written as a stream, so data is never
+                # kept in memory.
+                stream = tarfile.open(fileobj=writer, mode='w|',
+                                      format=tarfile.PAX_FORMAT)
+                for name, entry in _archive_entries(src_path):
+                    stream.add(entry.path, name, recursive=False)
+                    counter.update()
+                stream.close()
+            finally:
+                writer.close()
+
+
+def unpack(archive, dst_path, quiet=False):
+    """Unpack an archive to a directory."""
+    debug("unpack {} {}", archive, dst_path)
+    format = _archive_format(archive)
+    mktree(dst_path)
+    root = os.path.realpath(dst_path)
+    # Directory permissions are restored last so that read-only
+    # directories could be populated.
+    dirs = []
+    with progress("Unpacking %s" % archive) if not quiet else _NoProgress() \
+            as counter:
+        if format == 'zip':
+            stream = zipfile.ZipFile(archive)
+            try:
+                for info in stream.infolist():
+                    path = _safe_path(root, info.filename)
+                    mode = info.external_attr >> 16
+                    if stat.S_ISLNK(mode):
+                        link = stream.read(info).decode('utf-8')
+                        _safe_path(root, os.path.join(
+                                os.path.dirname(info.filename), link))
+                        _replace_link(link, path)
+                    elif info.filename.endswith('/'):
+                        mktree(path)
+                        if mode:
+                            dirs.append((path, mode, None))
+                    else:
+                        mktree(os.path.dirname(path))
+                        source = stream.open(info)
+                        with _AtomicFile(path, 'none',
+                                         _archive_mode(mode) or None) \
+                                as target:
+                            shutil.copyfileobj(source, target, 1024*1024)
+                        source.close()
+                    counter.update()
+            finally:
+                stream.close()
+        else:
+            if format == 'xz' and lzma is None:
+                raise fail("cannot unpack {}: xz is not supported",
+                           archive)
+            stream = tarfile.open(archive, 'r:'+format)
+            try:
+                for member in stream:
+                    path = _safe_path(root, member.name)
+                    if member.isdir():
+                        mktree(path)
+                        dirs.append((path, member.mode, member.mtime))
+                    elif member.issym():
+                        _safe_path(root, os.path.join(
+                                os.path.dirname(member.name),
+                                member.linkname))
+                        mktree(os.path.dirname(path))
+                        _replace_link(member.linkname, path)
+                    elif member.islnk():
+                        target = _safe_path(root, member.linkname)
+                        mktree(os.path.dirname(path))
+                        tmp_path = _temp_path(path)
+                        os.link(target, tmp_path)
+                        os.rename(tmp_path, path)
+                    elif member.isreg():
+                        mktree(os.path.dirname(path))
+                        source = stream.extractfile(member)
+                        with _AtomicFile(path, 'none',
+                                         _archive_mode(member.mode),
+                                         (member.mtime, member.mtime)) \
+                                as target:
+                            shutil.copyfileobj(source, target, 1024*1024)
+                        source.close()
+                    else:
+                        warn("skipping {}: not a regular file", member.name)
+                    counter.update()
+            finally:
+                stream.close()
+    for path, mode, mtime in reversed(dirs):
+        os.chmod(path, _archive_mode(mode))
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+
+def find(root, include=None, exclude=('.git',), ignore_file='.gitignore',
+         jobs=1):
+    """Find files and directories in a directory tree."""
+    include = [_Rule(pattern) for pattern in include or []]
+    rules = tuple(_Rule(pattern) for pattern in exclude or [])
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        dirs = [(root, '', rules)]
+        while dirs:
+            batch = dirs[-jobs:]
+            del dirs[-jobs:]
+            batch.reverse()
+            lister = lambda item: _find_list(item[0], item[1], item[2],
+                                             ignore_file)
+            if pool is not None:
+                listings = pool.map(lister, batch)
+            else:
+                listings = map(lister, batch)
+            for (dir_path, dir_name, dir_rules), (entries, rules) \
+                    in zip(batch, listings):
+                subdirs = []
+                for entry in entries:
+                    name = dir_name+entry.name
+                    is_dir = entry.is_dir()
+                    # The last matching rule wins.
+                    is_ignored = False
+                    for rule in rules:
+                        if rule.match(name, is_dir):
+                            is_ignored = not rule.is_negated
+                    if is_ignored:
+                        continue
+                    if not include or \
+                            any(rule.match(name, is_dir) for rule in include):
+                        yield entry
+                    if is_dir and not entry.is_symlink():
+                        subdirs.append((entry.path, name+'/', rules))
+                dirs.extend(reversed(subdirs))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+try:
+    # Python 3.5+.
+    _scandir = os.scandir
+except AttributeError:
+    # Python 2.
+    _scandir = None
+
+
+def _cpu_quota():
+    # Finds the CPU limit imposed by the cgroup of the process.
+    cgroup = ''
+    v1_cgroup = ''
+    try:
+        # Lines look like `0::/path` (v2) or `4:cpu,cpuacct:/path` (v1).
+        for line in open('/proc/self/cgroup'):
+            number, controllers, path = line.strip().split(':', 2)
+            if number == '0' and not controllers:
+                cgroup = path.lstrip('/')
+            elif 'cpu' in controllers.split(','):
+                v1_cgroup = path.lstrip('/')
+    except (IOError, ValueError):
+        pass
+    candidates = [
+            (os.path.join('/sys/fs/cgroup', cgroup, 'cpu.max'), None),
+            ('/sys/fs/cgroup/cpu.max', None),
+    ]
+    # The cgroup path may be relative to a mount of a parent cgroup,
+    # as in containers.
+    for v1_path in ([v1_cgroup, ''] if v1_cgroup else ['']):
+        for mount in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+            candidates.append(
+                    (os.path.join(mount, v1_path, 'cpu.cfs_quota_us'),
+                     os.path.join(mount, v1_path, 'cpu.cfs_period_us')))
+    for quota_path, period_path in candidates:
+        try:
+            if period_path is None:
+                # cgroup v2: "$MAX $PERIOD".
+                quota, period = open(quota_path).read().split()[:2]
+                if quota == 'max':
+                    return None
+            else:
+                # cgroup v1: quota and period in separate files.
+                quota = open(quota_path).read()
+                period = open(period_path).read()
+            quota = int(quota)
+            period = int(period)
+        except (IOError, ValueError):
+            continue
+        if quota <= 0 or period <= 0:
+            return None
+        return int(math.ceil(float(quota)/period))
+    return None
+
+
+def _limits(**limits):
+    # Fill in the limits that are not given with the configured defaults.
+    for key in sorted(env.limits):
+        if limits.get(key) is None:
+            limits[key] = env.limits[key]
+    return limits
+
+
+def _rlimits(limits):
+    # Generates `(resource, soft, hard)` for the resource limits.
+    for resource_id, value in [(resource.RLIMIT_CPU, limits['cpu_limit']),
+                               (resource.RLIMIT_AS, limits['mem_limit'])]:
+        if value is None:
+            continue
+        value = int(value)
+        soft, hard = resource.getrlimit(resource_id)
+        if resource_id == resource.RLIMIT_CPU:
+            # Send SIGXCPU first; SIGKILL a second later.
+            hard_value = value+1
+        else:
+            hard_value = value
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+            hard_value = min(hard_value, hard)
+        yield resource_id, value, hard_value
+
+
+def _apply_limits(limits):
+    # Restrict resources of the current process.
+    for resource_id, soft, hard in _rlimits(limits):
+        resource.setrlimit(resource_id, (soft, hard))
+    if limits['nice']:
+        os.nice(limits['nice'])
+
+
+def _limit_argv(argv, limits):
+    # Wraps the command to restrict its resources using the shell.
+    script = ""
+    for resource_id, soft, hard in _rlimits(limits):
+        if resource_id == resource.RLIMIT_CPU:
+            option = "-t"
+        else:
+            # `ulimit -v` accepts KiB.
+            option = "-v"
+            soft //= 1024
+            hard //= 1024
+        script += "ulimit -S %s %s && ulimit -H %s %s && " \
+                  % (option, soft, option, hard)
+    script += "exec "
+    if limits['nice']:
+        script += "nice -n %s " % int(limits['nice'])
+    script += '"$@"'
+    return ['/bin/sh', '-c', script, 'sh']+argv
+
+
+def _argv(cmd, environ):
+    # Prepares the command for execution; runs simple commands without
+    # the shell.
+    if isinstance(cmd, (list, tuple)):
+        return list(cmd)
+    if not _SHELL_CHARS.search(cmd):
+        try:
+            argv = shlex.split(cmd)
+        except ValueError:
+            argv = None
+        if argv and '=' not in argv[0] and \
+                argv[0] not in _SHELL_BUILTINS and \
+                _which(argv[0], environ) is not None:
+            return argv
+    return ['/bin/sh', '-c', cmd]
+
+
+_SHELL_CHARS = re.compile(r'[|&;<>()$`\\*?\[\]#~{}!\n]')
+
+_SHELL_BUILTINS = set(['.', ':', '[', 'alias', 'bg', 'break', 'case', 'cd',
+                       'command', 'continue', 'do', 'done', 'elif', 'else',
+                       'esac', 'eval', 'exec', 'exit', 'export', 'fc', 'fg',
+                       'fi', 'for', 'getopts', 'hash', 'if', 'jobs', 'read',
+                       'readonly', 'return', 'set', 'shift', 'source',
+                       'test', 'then', 'times', 'trap', 'type', 'ulimit',
+                       'umask', 'unalias', 'unset', 'until', 'wait',
+                       'while'])
+
+
+def _which(name, environ=None):
+    # Finds the executable in `$PATH`.
+    if os.sep in name:
+        return name if os.access(name, os.X_OK) else None
+    path = (environ or os.environ).get('PATH', os.defpath)
+    for dir_path in path.split(os.pathsep):
+        exe_path = os.path.join(dir_path or os.curdir, name)
+        if os.path.isfile(exe_path) and os.access(exe_path, os.X_OK):
+            return os.path.abspath(exe_path)
+    return None
+
+
+def _cmd_text(cmd):
+    # Formats the command for messages.
+    if isinstance(cmd, (list, tuple)):
+        return " ".join(_quote(arg) for arg in cmd)
+    return cmd
+
+
+def _popen(cmd, stdin, stdout, stderr, cd, environ, limits):
+    # Start a command with the given resource limits.
+    _export_settings()
+    if environ:
+        overrides = environ
+        environ = os.environ.copy()
+        environ.update(overrides)
+    argv = _argv(cmd, environ)
+    options = {}
+    if hasattr(os, 'posix_spawn'):
+        # Python 3.8+: avoid `preexec_fn`, so that `subprocess` could
+        # use `posix_spawn()` or `vfork()` instead of copying the whole
+        # process with `fork()`.
+        if any(limits[key] is not None
+               for key in ['cpu_limit', 'mem_limit', 'nice']):
+            argv = _limit_argv(argv, limits)
+        if limits['timeout'] is not None:
+            # Make the command and its children a process group
+            # so that we could kill them all on timeout.
+            if sys.version_info >= (3, 11):
+                options['process_group'] = 0
+            else:
+                options['preexec_fn'] = os.setpgrp
+        # Descriptors are not inherited by default since Python 3.4.
+        options['close_fds'] = False
+        options['executable'] = _which(argv[0], environ) or argv[0]
+    else:
+        # Python 2 always forks the process, so `preexec_fn` costs
+        # nothing extra; only the shell is skipped.
+        def preexec_fn():
+            # Python 2 does not restore the default SIGPIPE handler.
+            signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+            if limits['timeout'] is not None:
+                os.setpgid(0, 0)
+            _apply_limits(limits)
+        options['preexec_fn'] = preexec_fn
+    try:
+        return subprocess.Popen(argv, stdin=stdin,
+                                stdout=stdout, stderr=stderr,
+                                cwd=cd, env=environ, **options)
+    except OSError, exc:
+        raise fail("`{}`: {}", _cmd_text(cmd), exc.strerror)
+
+
+def _communicate(proc, cmd, data, limits):
+    # Wait for the command to complete; kill it if it runs out of time.
+    timeout = limits['timeout']
+    if timeout is None:
+        return proc.communicate(data)
+    expired = []
+    def kill():
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    def expire():
+        expired.append(time.time())
+        kill()
+    timer = threading.Timer(timeout, expire)
+    timer.daemon = True
+    start = time.time()
+    timer.start()
+    try:
+        out, err = proc.communicate(data)
+    except BaseException:
+        # The command is not in our process group, so it is not going
+        # to get SIGINT from the terminal.
+        kill()
+        proc.wait()
+        raise
+    finally:
+        timer.cancel()
+        timer.join()
+    if expired:
+        if err:
+            lines = err.splitlines()[-10:]
+            stream = getattr(sys.stderr, 'buffer', sys.stderr)
+            stream.write(b"\n".join(lines)+b"\n")
+        raise _timeout(cmd, expired[0]-start, limits, [proc.pid])
+    return out, err
+
+
+def _timeout(cmd, elapsed, limits, pids):
+    # Report a command killed on timeout.
+    return fail("`{}`: timed out after {} seconds"
+                " (limits: {}; process group{} {} killed)",
+                cmd, round(elapsed, 1),
+                ", ".join("%s=%s" % (key.replace('_', '-'), limits[key])
+                          for key in sorted(limits)
+                          if limits[key] is not None),
+                "s" if len(pids) > 1 else "", ", ".join(str(pid) for pid in pids))
+
+
+def _failure(cmd, returncode):
+    # Report a failed command.
+    if returncode < 0:
+        return fail("`{}`: killed by signal {}", cmd, -returncode)
+    return fail("`{}`: non-zero exit code", cmd)
+
+
+class _DirEntry(object):
+    # Emulates `os.DirEntry` on top of `os.lstat()`.
+
+    __slots__ = ('name', 'path', '_lstat', '_stat')
+
+    def __init__(self, dir_path, name):
+        self.name = name
+        self.path = os.path.join(dir_path, name)
+        self._lstat = None
+        self._stat = None
+
+    def inode(self):
+        return self.stat(follow_symlinks=False).st_ino
+
+    def stat(self, follow_symlinks=True):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        if follow_symlinks and stat.S_ISLNK(self._lstat.st_mode):
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(False).st_mode)
+        except OSError:
+            return False
+
+
+def _entries(path):
+    # List directory entries as `DirEntry` objects.
+    if _scandir is not None:
+        return list(_scandir(path))
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def _glob_root(pattern):
+    # Finds the longest leading part of the pattern without wildcards.
+    parts = []
+    for part in pattern.split(os.sep):
+        if re.search(r'[*?[]', part):
+            break
+        parts.append(part)
+    root = os.sep.join(parts)
+    if not root:
+        root = os.sep if pattern.startswith(os.sep) else os.curdir
+    return root
+
+
+def _match(path, patterns):
+    # Checks if the path or any of its parents matches any pattern.
+    path = os.path.normpath(path)
+    if os.curdir in patterns and not os.path.isabs(path):
+        return True
+    while path:
+        for pattern in patterns:
+            if fnmatch.fnmatch(path, pattern):
+                return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return False
+
+
+def _find_list(path, name, rules, ignore_file):
+    # Lists a directory; loads rules from the ignore file.
+    try:
+        entries = sorted(_entries(path), key=(lambda entry: entry.name))
+    except OSError:
+        return [], rules
+    if ignore_file:
+        for entry in entries:
+            if entry.name == ignore_file and entry.is_file():
+                try:
+                    lines = open(entry.path).read().splitlines()
+                except IOError:
+                    break
+                rules += tuple(_Rule(line, name)
+                               for line in lines
+                               if line.strip() and not line.startswith('#'))
+                break
+    return entries, rules
+
+
+class _Rule(object):
+    # A pattern in the `.gitignore` format.
+
+    def __init__(self, pattern, base=''):
+        pattern = pattern.rstrip()
+        self.is_negated = pattern.startswith('!')
+        if self.is_negated:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\'):
+            pattern = pattern[1:]
+        self.is_dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        # Patterns with a slash are relative to the base directory.
+        is_anchored = ('/' in pattern)
+        pattern = pattern.lstrip('/')
+        regex = re.escape(base)
+        if not is_anchored:
+            regex += '(?:.*/)?'
+        parts = re.split(r'(\*\*/|/\*\*|\*\*|\*|\?|\[[^\]]*\])', pattern)
+        for part in parts:
+            if part == '**/':
+                regex += '(?:.*/)?'
+            elif part == '/**':
+                regex += '/.*'
+            elif part == '**':
+                regex += '.*'
+            elif part == '*':
+                regex += '[^/]*'
+            elif part == '?':
+                regex += '[^/]'
+            elif part.startswith('[') and part.endswith(']') and part != '[]':
+                if part.startswith('[!'):
+                    part = '[^'+part[2:]
+                regex += part
+            else:
+                regex += re.escape(part)
+        self.regex = re.compile(regex+'$')
+
+    def match(self, name, is_dir):
+        if self.is_dir_only and not is_dir:
+            return False
+        return (self.regex.match(name) is not None)
+
+
+class _Inotify(object):
+    # Reports filesystem events using Linux inotify API.
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0x00080000
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, roots):
+        if ctypes is None or not sys.platform.startswith('linux'):
+            raise OSError("inotify is not available")
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.roots = roots
+        self.paths = {}
+        try:
+            for root in roots:
+                self.add(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, path):
+        # Watch the directory and all its subdirectories.
+        encoded = path
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode(sys.getfilesystemencoding())
+        wd = self.add_watch(self.fd, encoded, self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            if errno == 2:  # ENOENT: removed before we got to it.
+                return
+            raise OSError(errno, "%s: %s" % (path, os.strerror(errno)))
+        self.paths[wd] = path
+        if os.path.isdir(path) and not os.path.islink(path):
+            try:
+                entries = _entries(path)
+            except OSError:
+                return
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    self.add(entry.path)
+
+    def read(self, timeout):
+        ready = select.select([self.fd], [], [], timeout)[0]
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        changes = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                changes.extend(self.roots)
+                continue
+            if wd not in self.paths:
+                continue
+            path = self.paths[wd]
+            if name:
+                if not isinstance(name, str):
+                    name = name.decode(sys.getfilesystemencoding())
+                path = os.path.join(path, name)
+            if mask & self.IN_IGNORED:
+                del self.paths[wd]
+                continue
+            if (mask & self.IN_ISDIR and
+                    mask & (self.IN_CREATE | self.IN_MOVED_TO)):
+                try:
+                    self.add(path)
+                except OSError, exc:
+                    debug("cannot watch {}: {}", path, exc)
+            changes.append(path)
+        return changes
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class _Poll(object):
+    # Detects changes by periodically scanning the file tree.
+
+    def __init__(self, roots, interval):
+        self.roots = roots
+        self.interval = interval
+        self.state = self.scan()
+
+    def scan(self):
+        state = {}
+        queue = list(self.roots)
+        while queue:
+            path = queue.pop()
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                try:
+                    entries = _entries(path)
+                except OSError:
+                    continue
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        queue.append(entry.path)
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    state[entry.path] = (st.st_mtime, st.st_size,
+                                         st.st_ino, st.st_mode)
+            else:
+                state[path] = (st.st_mtime, st.st_size,
+                               st.st_ino, st.st_mode)
+        return state
+
+    def read(self, timeout):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+        state = self.scan()
+        changes = [path for path in state
+                   if self.state.get(path) != state[path]]
+        changes.extend(path for path in self.state if path not in state)
+        self.state = state
+        return changes
+
+    def close(self):
+        pass
+
+
+class _PlanOp(object):
+    # Operation recorded by `plan`.
+
+    def __init__(self, kind, path, dst_path=None,
+                 writes=(), reads=(), needs=()):
+        self.kind = kind
+        self.path = path
+        self.dst_path = dst_path
+        # Trees that are modified, read, and directories that must exist.
+        self.writes = list(writes)
+        self.reads = list(reads)
+        self.needs = list(needs)
+        self.level = 0
+
+    def execute(self, record, backup):
+        # Performs the operation, recording actions that revert it.
+        # Runs in a worker thread, so it must not use `env`.
+        if self.kind == 'cp':
+            target = self.dst_path
+            if os.path.isdir(target):
+                target = os.path.join(target, os.path.basename(self.path))
+            _backup(target, backup, record)
+            record(('created', target))
+            _cp(self.path, self.dst_path)
+        elif self.kind == 'mv':
+            _backup(self.dst_path, backup, record)
+            record(('renamed', self.dst_path, self.path))
+            os.rename(self.path, self.dst_path)
+        elif self.kind in ['rm', 'rmtree']:
+            if self.kind == 'rm' and os.path.isdir(self.path) and \
+                    not os.path.islink(self.path):
+                raise OSError(errno.EISDIR, os.strerror(errno.EISDIR),
+                              self.path)
+            if not os.path.lexists(self.path):
+                raise OSError(errno.ENOENT, os.strerror(errno.ENOENT),
+                              self.path)
+            _backup(self.path, backup, record)
+        elif self.kind == 'mktree':
+            root = self.path
+            while not os.path.exists(os.path.dirname(root)):
+                root = os.path.dirname(root)
+            if not os.path.exists(root):
+                record(('created', root))
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+    def __str__(self):
+        if self.dst_path is not None:
+            return "%s %s %s" % (self.kind, self.path, self.dst_path)
+        return "%s %s" % (self.kind, self.path)
+
+
+class _PlanIndex(object):
+    # Paths used by plan operations.  Operations conflict, that is, must
+    # run in the recorded order, if one writes a tree that the other
+    # writes, reads, or needs to exist.
+
+    def __init__(self):
+        # Maps a path to the operations that use it, and to those that
+        # use it or any path below it.
+        self.at = {'writes': {}, 'reads': {}}
+        self.below = {'writes': {}, 'reads': {}, 'needs': {}}
+
+    def add(self, idx, op):
+        for kind in ['writes', 'reads', 'needs']:
+            for path in getattr(op, kind):
+                if kind in self.at:
+                    self.at[kind].setdefault(path, set()).add(idx)
+                for parent in _ancestors(path):
+                    self.below[kind].setdefault(parent, set()).add(idx)
+
+    def conflicts(self, op):
+        # Finds the added operations that conflict with the operation.
+        found = set()
+        for path in op.writes+op.reads:
+            found.update(self.related('writes', path))
+        for path in op.needs:
+            found.update(self.above('writes', path))
+        for path in op.writes:
+            found.update(self.related('reads', path))
+            found.update(self.below['needs'].get(path, ()))
+        return found
+
+    def above(self, kind, path):
+        # Operations using the path or any of its parents.
+        for parent in _ancestors(path):
+            for idx in self.at[kind].get(parent, ()):
+                yield idx
+
+    def related(self, kind, path):
+        # Operations using a path which contains or is contained in
+        # the given path.
+        for idx in self.above(kind, path):
+            yield idx
+        for idx in self.below[kind].get(path, ()):
+            yield idx
+
+
+def _ancestors(path):
+    # The path itself and all its parents.
+    while True:
+        yield path
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+
+def _is_ancestor(path, other):
+    # Checks if the path is the same or contains the other path.
+    return (path == other or
+            other.startswith(path.rstrip(os.path.sep)+os.path.sep))
+
+
+def _is_related(path, other):
+    # Checks if one of the paths contains the other.
+    return _is_ancestor(path, other) or _is_ancestor(other, path)
+
+
+def _backup(path, backup, record):
+    # Moves the file aside so that it could be restored.
+    if not os.path.lexists(path):
+        return
+    dir_path, name = os.path.split(path)
+    backup_path = os.path.join(dir_path, ".%s.%s~" % (name, backup()))
+    record(('backup', backup_path, path))
+    os.rename(path, backup_path)
+
+
+def _undo(action):
+    # Reverts a step of a plan operation; the step may be recorded,
+    # but not made.
+    try:
+        if action[0] == 'created':
+            _remove_tree(action[1])
+        elif action[0] in ['renamed', 'backup']:
+            if os.path.lexists(action[1]):
+                os.rename(action[1], action[2])
+    except (IOError, OSError), exc:
+        warn("cannot roll back {}: {}", action[1], exc)
+
+
+class _PlanJournal(object):
+    # Steps of a running plan, saved on disk so that the plan could be
+    # rolled back if the process dies.  The file is locked while the
+    # plan runs.
+
+    def __init__(self, token):
+        dir_path = _plans_dir()
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        self.path = os.path.join(dir_path, "%s-%s.journal"
+                                 % (os.getpid(), token))
+        # Lock the file before it could be found by `_recover_plans()`.
+        tmp_path = _temp_path(self.path)
+        self.fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                                    os.O_APPEND, 0o600)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD,
+                    fcntl.fcntl(self.fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        os.rename(tmp_path, self.path)
+        self.lock = threading.Lock()
+
+    def record(self, action):
+        # Unbuffered, so that the record survives if the process dies.
+        data = (json.dumps(action)+"\n").encode('utf-8')
+        with self.lock:
+            while data:
+                data = data[os.write(self.fd, data):]
+
+    def close(self):
+        # The plan is complete or rolled back.
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        os.close(self.fd)
+
+
+def _plans_dir():
+    # Where journals of running plans are kept.
+    return os.path.join(env.shell.cache_dir, 'plans')
+
+
+def _recover_plans():
+    # Rolls back the plans of processes that died while running them;
+    # completes those that died while removing the replaced files.
+    dir_path = _plans_dir()
+    try:
+        names = sorted(os.listdir(dir_path))
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith('.journal'):
+            continue
+        path = os.path.join(dir_path, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # The plan is still running.
+                continue
+            try:
+                if not os.path.samestat(os.fstat(fd), os.stat(path)):
+                    continue
+            except OSError:
+                continue
+            actions = []
+            with io.open(fd, 'rb', closefd=False) as stream:
+                for line in stream:
+                    try:
+                        actions.append(json.loads(line.decode('utf-8')))
+                    except ValueError:
+                        # Cut short when the process died.
+                        break
+            if ['commit'] in actions:
+                for action in actions:
+                    if action[0] == 'backup':
+                        try:
+                            _remove_tree(action[1])
+                        except (IOError, OSError), exc:
+                            warn("cannot remove {}: {}", action[1], exc)
+            else:
+                warn("rolling back interrupted plan {}", path)
+                for action in reversed(actions):
+                    _undo(action)
+            os.unlink(path)
+        finally:
+            os.close(fd)
+
+
+def _remove_tree(path):
+    # Removes a file or a directory tree.
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def _memory_free(path):
+    # Space available in a memory file system.
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return 0
+    free = st.f_bavail*st.f_frsize
+    # Pages of a memory file system may be swapped out, so we also
+    # make sure the system has that much memory.
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemAvailable:'):
+                free = min(free, int(line.split()[1])*1024)
+    except (IOError, ValueError):
+        pass
+    return free
+
+
+def _jobs(jobs):
+    # Number of worker threads to use.
+    if jobs is None:
+        jobs = getattr(env, 'jobs', None) or cpu_count()
+    return jobs
+
+
+def _to_bytes(text):
+    # Encodes a file name or other text.
+    if not isinstance(text, bytes):
+        try:
+            # Python 3 escapes undecodable bytes in file names.
+            text = os.fsencode(text)
+        except AttributeError:
+            text = text.encode(sys.getfilesystemencoding())
+    return text
+
+
+def _cache_key(path):
+    # A file name that survives a round trip through JSON; the name
+    # may not be valid UTF-8.
+    return binascii.hexlify(_to_bytes(path)).decode('ascii')
+
+
+def _mtime_ns(st):
+    # Modification time in nanoseconds.
+    try:
+        # Python 3.3+.
+        return st.st_mtime_ns
+    except AttributeError:
+        # Python 2.
+        return int(st.st_mtime*1e9)
+
+
+def _hash_file(path, size, algorithm):
+    # Calculates the digest of a file.
+    hash = hashlib.new(algorithm)
+    stream = open(path, 'rb')
+    try:
+        if size >= 1024*1024:
+            # Hash large files in place; `hashlib` releases the GIL
+            # while hashing, so this runs in parallel.
+            data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                hash.update(data)
+            finally:
+                data.close()
+        else:
+            hash.update(stream.read())
+    finally:
+        stream.close()
+    return hash.hexdigest()
+
+
+def _save_json(path, data):
+    # Saves JSON data, replacing the file atomically.
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with _AtomicFile(path, 'none') as stream:
+        stream.write(json.dumps(data))
+
+
+def _sync_item(src_path, src_st, dst_path, dst_st, checksum):
+    # Decides if the file needs to be copied.
+    if dst_st is not None and stat.S_ISREG(dst_st.st_mode) and \
+            src_st.st_size == dst_st.st_size:
+        if checksum:
+            return (src_path, dst_path, src_st.st_size, True)
+        if int(src_st.st_mtime) == int(dst_st.st_mtime):
+            return None
+    return (src_path, dst_path, src_st.st_size, False)
+
+
+def _cp(src_path, dst_path):
+    # Copies a file or a directory tree.
+    if os.path.isfile(src_path):
+        if os.path.isdir(dst_path):
+            dst_path = os.path.join(dst_path, os.path.basename(src_path))
+        _replace_file(src_path, dst_path)
+    elif os.path.islink(src_path):
+        link = os.readlink(src_path)
+        os.symlink(link, dst_path)
+    else:
+        if os.path.exists(dst_path):
+            dst_path = os.path.join(dst_path, os.path.basename(src_path))
+        os.mkdir(dst_path)
+        for filename in os.listdir(src_path):
+            _cp(os.path.join(src_path, filename),
+                os.path.join(dst_path, filename))
+
+
+def _replace_file(src_path, dst_path):
+    # Copies a file, replacing the target atomically.
+    src_stream = open(src_path, 'rb')
+    try:
+        st = os.fstat(src_stream.fileno())
+        with _AtomicFile(dst_path, 'none', stat.S_IMODE(st.st_mode),
+                         (st.st_atime, st.st_mtime)) as stream:
+            shutil.copyfileobj(src_stream, stream, 1024*1024)
+    finally:
+        src_stream.close()
+
+
+def _replace_link(link, path):
+    # Creates a symbolic link, replacing the target atomically.
+    tmp_path = _temp_path(path)
+    os.symlink(link, tmp_path)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+class _EmptyMap(bytes):
+    # Stands for the memory map of an empty file.
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+# Unnamed temporary files could be linked via `/proc` (Python 3.4+, Linux).
+_O_TMPFILE = (getattr(os, 'O_TMPFILE', None)
+              if os.path.isdir('/proc/self/fd') else None)
+
+
+class _AtomicFile(object):
+    # Buffered output to a temporary file, which replaces the target
+    # file when closed.
+
+    # Reset if the system fails to link unnamed files.
+    use_tmpfile = (_O_TMPFILE is not None)
+
+    def __init__(self, path, durability, mode=None, times=None):
+        self.path = path
+        self.durability = durability
+        self.times = times
+        self.tmp_path = None
+        if mode is None and os.path.exists(path):
+            # Keep permissions of the replaced file.
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        fd = None
+        if self.use_tmpfile:
+            # Nothing is left behind if the process dies.
+            try:
+                fd = os.open(os.path.dirname(path) or os.curdir,
+                             _O_TMPFILE | os.O_RDWR, 0o666)
+            except OSError, exc:
+                if exc.errno not in [errno.EOPNOTSUPP, errno.EISDIR,
+                                     errno.EINVAL]:
+                    raise
+        if fd is None:
+            self.tmp_path = _temp_path(path)
+            fd = os.open(self.tmp_path,
+                         os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        if mode is not None:
+            os.fchmod(fd, mode)
+        self.stream = io.open(fd, 'wb', buffering=1024*1024)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return self.stream.write(data)
+
+    def close(self):
+        # Moves the file into place.
+        if self.stream.closed:
+            return
+        try:
+            self.stream.flush()
+            fd = self.stream.fileno()
+            if self.durability != 'none':
+                os.fsync(fd)
+            if self.tmp_path is None:
+                self.link(fd)
+            if self.times is not None:
+                os.utime(self.tmp_path, self.times)
+            os.rename(self.tmp_path, self.path)
+            self.tmp_path = None
+        except:
+            self.discard()
+            raise
+        self.stream.close()
+        if self.durability == 'full':
+            dir_fd = os.open(os.path.dirname(self.path) or os.curdir,
+                             os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def link(self, fd):
+        # Gives the unnamed file a temporary name.
+        tmp_path = _temp_path(self.path)
+        try:
+            os.link('/proc/self/fd/%s' % fd, tmp_path, follow_symlinks=True)
+        except OSError, exc:
+            if exc.errno not in [errno.EXDEV, errno.ENOENT, errno.EPERM]:
+                raise
+            debug("cannot link unnamed files: {}", exc)
+            _AtomicFile.use_tmpfile = False
+            # Copy the data to a named file.
+            copy_fd = os.open(tmp_path,
+                              os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            self.tmp_path = tmp_path
+            try:
+                os.fchmod(copy_fd, stat.S_IMODE(os.fstat(fd).st_mode))
+                with io.open(fd, 'rb', closefd=False) as src_stream:
+                    src_stream.seek(0)
+                    with io.open(copy_fd, 'wb') as stream:
+                        shutil.copyfileobj(src_stream, stream, 1024*1024)
+                        stream.flush()
+                        if self.durability != 'none':
+                            os.fsync(copy_fd)
+            except:
+                self.discard()
+                raise
+            return
+        self.tmp_path = tmp_path
+
+    def discard(self):
+        # Removes the temporary file.
+        try:
+            self.stream.close()
+        except (IOError, OSError):
+            pass
+        if self.tmp_path is not None:
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+            self.tmp_path = None
+
+    def __getattr__(self, name):
+        if name == 'stream':
+            raise AttributeError(name)
+        return getattr(self.stream, name)
+
+
+def _temp_path(path):
+    # Generates a name for a temporary file next to the given file.
+    dir_path, name = os.path.split(path)
+    return os.path.join(dir_path, ".%s.%s~"
+                        % (name, binascii.hexlify(os.urandom(6))
+                                         .decode('ascii')))
+
+
+def _walk(path):
+    # Generates `(name, entry)` for all files and directories in the tree,
+    # listing one directory at a time.
+    dirs = [(path, '')]
+    while dirs:
+        dir_path, dir_name = dirs.pop()
+        entries = sorted(_entries(dir_path), key=(lambda entry: entry.name))
+        subdirs = []
+        for entry in entries:
+            name = dir_name+entry.name
+            yield name, entry
+            if entry.is_dir() and not entry.is_symlink():
+                subdirs.append((entry.path, name+'/'))
+        dirs.extend(reversed(subdirs))
+
+
+def _archive_entries(path):
+    # Generates the files, directories and symbolic links to pack.
+    for name, entry in _walk(path):
+        if entry.is_symlink() or entry.is_dir() or entry.is_file():
+            yield name, entry
+        else:
+            # Reading a FIFO or a device may never end.
+            debug("skipping {}: not a regular file", entry.path)
+
+
+def _archive_mode(mode):
+    # Permissions of an unpacked file or directory.  Like the `tar`
+    # filter of Python 3.12, drop setuid, setgid, sticky and group/other
+    # write permissions.
+    return stat.S_IMODE(mode) & 0o755
+
+
+def _archive_format(archive):
+    # Determines the archive format from the file name.
+    name = archive.lower()
+    if name.endswith('.tar.gz') or name.endswith('.tgz'):
+        return 'gz'
+    if name.endswith('.tar.xz') or name.endswith('.txz'):
+        if lzma is None:
+            raise fail("cannot pack {}: xz is not supported", archive)
+        return 'xz'
+    if name.endswith('.zip'):
+        return 'zip'
+    raise fail("unknown archive format: {}", archive)
+
+
+def _safe_path(root, name):
+    # Finds where the archive member is extracted; rejects members that
+    # escape the target directory.
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.isabs(name) or \
+            (path != root and not path.startswith(root+os.sep)):
+        raise fail("unsafe archive member: {}", name)
+    return os.path.join(root, os.path.normpath(name))
+
+
+def _zip_add(stream, name, entry):
+    # Adds a file to a ZIP archive.
+    st = entry.stat(follow_symlinks=False)
+    if stat.S_ISLNK(st.st_mode):
+        info = zipfile.ZipInfo(name, time.localtime(st.st_mtime)[:6])
+        info.create_system = 3
+        info.external_attr = st.st_mode << 16
+        stream.writestr(info, _to_bytes(os.readlink(entry.path)))
+    else:
+        stream.write(entry.path, name)
+
+
+def _gzip_block(data):
+    # Compresses a block as a standalone gzip member.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+    return compressor.compress(data)+compressor.flush()
+
+
+def _xz_block(data):
+    # Compresses a block as a standalone xz stream.
+    return lzma.compress(data, format=lzma.FORMAT_XZ)
+
+
+class _BlockWriter(object):
+    # File-like object that splits the data into blocks and compresses
+    # them in parallel.  Compressed blocks are concatenated in order,
+    # which gives a valid multi-member gzip or multi-stream xz file.
+
+    def __init__(self, stream, compress, block_size, jobs):
+        self.stream = stream
+        self.compress = compress
+        self.block_size = block_size
+        self.jobs = jobs
+        self.pool = multiprocessing.pool.ThreadPool(jobs)
+        self.pending = collections.deque()
+        self.chunks = []
+        self.size = 0
+        self.count = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.block_size:
+            self.submit()
+
+    def submit(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        self.count += 1
+        self.pending.append(self.pool.apply_async(self.compress, (data,)))
+        # Limit the number of blocks in memory.
+        while len(self.pending) > 2*self.jobs:
+            self.stream.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.pool is None:
+            return
+        try:
+            if self.chunks or not self.count:
+                self.submit()
+            while self.pending:
+                self.stream.write(self.pending.popleft().get())
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class _NoProgress(object):
+    # Stands in for `progress` when progress is not reported.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+    def update(self, count=1):
+        pass
+
+
+_Stage = collections.namedtuple('_Stage', ['cmd', 'cd', 'environ'])
+
+
+class _Pipeline(object):
+    # Commands connected with pipes.
+
+    def __init__(self, stages, data, output, timeout):
+        self.stages = stages
+        self.procs = []
+        # Stage errors are collected in files so that a chatty stage
+        # could not block the pipeline.
+        self.errs = []
+        self.limits = limits = _limits(timeout=timeout, cpu_limit=None,
+                                       mem_limit=None, nice=None)
+        self.timer = None
+        self.expired = []
+        output_file = None
+        if output is not None:
+            output_file = open(output, 'wb')
+        try:
+            stdin = None
+            if data is not None:
+                stdin = subprocess.PIPE
+            for index, item in enumerate(stages):
+                stdout = subprocess.PIPE
+                if index == len(stages)-1 and output_file is not None:
+                    stdout = output_file
+                err = tempfile.TemporaryFile()
+                self.errs.append(err)
+                proc = _popen(item.cmd, stdin, stdout, err,
+                              item.cd, item.environ, limits)
+                if self.procs:
+                    # Now the pipe belongs to the child.
+                    self.procs[-1].stdout.close()
+                self.procs.append(proc)
+                stdin = proc.stdout
+        except BaseException:
+            self.kill()
+            raise
+        finally:
+            if output_file is not None:
+                output_file.close()
+        self.stdout = self.procs[-1].stdout
+        if limits['timeout'] is not None:
+            self.start = time.time()
+            self.timer = threading.Timer(limits['timeout'], self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+        self.feeder = None
+        if data is not None:
+            self.feeder = threading.Thread(target=self.feed, args=(data,))
+            self.feeder.daemon = True
+            self.feeder.start()
+
+    def feed(self, data):
+        stdin = self.procs[0].stdin
+        try:
+            stdin.write(data)
+        except (IOError, OSError):
+            pass
+        try:
+            stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def iterate(self):
+        try:
+            for line in iter(self.stdout.readline, b""):
+                yield line
+        except BaseException:
+            self.kill()
+            raise
+        self.wait()
+
+    def wait(self):
+        if self.feeder is not None:
+            self.feeder.join()
+        if self.stdout is not None:
+            self.stdout.close()
+        for proc in self.procs:
+            proc.wait()
+        self.cancel()
+        if self.expired:
+            for err in self.errs:
+                err.close()
+            raise _timeout(" | ".join(_cmd_text(item.cmd)
+                                      for item in self.stages),
+                           self.expired[0]-self.start, self.limits,
+                           [proc.pid for proc in self.procs])
+        failed = None
+        for index, proc in enumerate(self.procs):
+            # A stage is killed with SIGPIPE when the next stage
+            # does not read all its input.
+            if index < len(self.procs)-1 and \
+                    proc.returncode in [-signal.SIGPIPE,
+                                        128+signal.SIGPIPE]:
+                continue
+            if proc.returncode != 0:
+                failed = index
+                break
+        for index, err in enumerate(self.errs):
+            if env.debug or index == failed:
+                err.seek(0)
+                data = err.read()
+                if data:
+                    stream = getattr(sys.stderr, 'buffer', sys.stderr)
+                    stream.write(data)
+                    stream.flush()
+            err.close()
+        if failed is not None:
+            raise _failure(_cmd_text(self.stages[failed].cmd),
+                           self.procs[failed].returncode)
+
+    def expire(self):
+        self.expired.append(time.time())
+        self.killpg()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer.join()
+            self.timer = None
+
+    def killpg(self):
+        # With a timeout, each stage is a separate process group.
+        for proc in self.procs:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def kill(self):
+        self.cancel()
+        if self.limits['timeout'] is not None:
+            # The stages are not in our process group, so they are not
+            # going to get SIGINT from the terminal.
+            self.killpg()
+        for proc in self.procs:
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            if proc.stdout is not None:
+                proc.stdout.close()
+        for err in self.errs:
+            err.close()
+
+
@@ -0,0 +1,205 @@
+#
+# Copyright (c) 2013, Prometheus Research, LLC
+# Released under MIT license, see `LICENSE` for details.
+#
+
+
+from .core import env, _exit_status
+from .log import debug, warn
+import os
+import io
+import time
+import json
+import fcntl
+import resource
+import sqlite3
+
+
+class History(object):
+    """Database of past task invocations."""
+
+    # Records older than that many seconds are pruned.
+    MAX_AGE = 180*24*60*60
+    # Only that many most recent records are kept.
+    MAX_ROWS = 100000
+    # Spooled records are moved to the database when the spool grows
+    # larger than that.
+    SPOOL_SIZE = 64*1024
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS run (
+            id INTEGER PRIMARY KEY,
+            task TEXT NOT NULL,
+            arguments TEXT NOT NULL,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            cpu_time REAL NOT NULL,
+            status INTEGER NOT NULL,
+            versions TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS run_task_started ON run (task, started);
+    """
+
+    FIELDS = ['task', 'arguments', 'started', 'duration',
+              'cpu_time', 'status', 'versions']
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.spool_path = self.path+'.spool'
+
+    def record(self, **fields):
+        """Add a record."""
+        # A single append is cheap, so we spool records and move them
+        # to the database in batches.
+        line = json.dumps(fields, sort_keys=True)+"\n"
+        dir_path = os.path.dirname(self.path)
+        if dir_path and not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        fd = self.lock_spool(os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+        if size >= self.SPOOL_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Move spooled records to the database."""
+        try:
+            fd = self.lock_spool(os.O_RDWR)
+        except OSError:
+            return
+        try:
+            rows = []
+            with io.open(fd, 'rb', closefd=False) as stream:
+                for line in stream:
+                    try:
+                        fields = json.loads(line.decode('utf-8'))
+                        rows.append(tuple(fields[field]
+                                          for field in self.FIELDS))
+                    except (ValueError, KeyError, TypeError):
+                        continue
+            debug("saving {} records to {}", len(rows), self.path)
+            connection = self.connect()
+            try:
+                with connection:
+                    connection.executemany(
+                            "INSERT INTO run (%s) VALUES (%s)"
+                            % (", ".join(self.FIELDS),
+                               ", ".join("?" for field in self.FIELDS)),
+                            rows)
+                    connection.execute(
+                            "DELETE FROM run WHERE started < ?",
+                            (time.time()-self.MAX_AGE,))
+                    connection.execute(
+                            "DELETE FROM run WHERE id <= ("
+                            "SELECT id FROM run ORDER BY id DESC"
+                            " LIMIT 1 OFFSET ?)",
+                            (self.MAX_ROWS,))
+            finally:
+                connection.close()
+            # The records are kept in the spool if saving them fails.
+            os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+    def lock_spool(self, flags):
+        # Opens the spool holding a lock; records are not added while
+        # the spool is moved to the database, and only one process
+        # writes to the database at a time.
+        fd = os.open(self.spool_path, flags, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def runs(self, task=None):
+        """Fetch records, oldest first."""
+        self.flush()
+        if not os.path.exists(self.path):
+            return []
+        connection = self.connect()
+        try:
+            query = "SELECT %s FROM run" % ", ".join(self.FIELDS)
+            params = ()
+            if task is not None:
+                query += " WHERE task = ?"
+                params = (task,)
+            query += " ORDER BY started"
+            return [dict(zip(self.FIELDS, row))
+                    for row in connection.execute(query, params)]
+        finally:
+            connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.executescript(self.SCHEMA)
+        return connection
+
+
+class HistoryRecorder(object):
+    """Records the enclosed task invocation in the history database."""
+
+    def __init__(self, task, attrs):
+        self.task = task
+        self.attrs = attrs
+        # Set to the value returned by the task.
+        self.result = None
+
+    def __enter__(self):
+        self.started = time.time()
+        self.cpu_time = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not env.history:
+            return
+        if exc_type is None:
+            status = _exit_status(self.result)
+        elif issubclass(exc_type, KeyboardInterrupt):
+            status = 130
+        else:
+            status = 1
+        try:
+            History(env.history).record(
+                    task=self.task.name,
+                    arguments=json.dumps(self.attrs, sort_keys=True,
+                                         default=repr),
+                    started=self.started,
+                    duration=time.time()-self.started,
+                    cpu_time=_cpu_time()-self.cpu_time,
+                    status=status,
+                    versions=" ".join(_versions()))
+        except (EnvironmentError, sqlite3.Error), exc:
+            warn("failed to record the task in {}: {}", env.history, exc)
+
+
+def _cpu_time():
+    # CPU time used by completed subprocesses.
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime+usage.ru_stime
+
+
+_VERSIONS = {}
+def _versions():
+    # Distributions which provide extensions.
+    if env.shell.registry is not None:
+        return env.shell.registry['versions']
+    # Scanning installed distributions is slow; do it once.
+    if env.shell.entry_point not in _VERSIONS:
+        versions = set()
+        if env.shell.entry_point:
+            import pkg_resources
+            for entry in pkg_resources.iter_entry_points(
+                    env.shell.entry_point):
+                if entry.dist is not None:
+                    versions.add("%s==%s" % (entry.dist.project_name,
+                                             entry.dist.version))
+        _VERSIONS[env.shell.entry_point] = sorted(versions)
+    return _VERSIONS[env.shell.entry_point]
+
+
+
@@ -0,0 +1,118 @@
+#
+# Copyright (c) 2013, Prometheus Research, LLC
+# Released under MIT license, see `LICENSE` for details.
+#
+
+
+from .core import env
+from .log import debug, warn
+import os
+import json
+import hashlib
+import cPickle as pickle
+
+
+class Journal(object):
+    """Records completed steps of the enclosed task run."""
+
+    def __init__(self, task, attrs):
+        self.task = task
+        key = json.dumps([task.name, attrs], sort_keys=True, default=repr)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.dir_path = os.path.join(env.shell.cache_dir, 'journals')
+        self.path = os.path.join(self.dir_path, key+'.journal')
+        self.steps = {}
+        self.fd = None
+
+    def __enter__(self):
+        if env.resume:
+            self.steps = self.load()
+            if self.steps:
+                debug("resuming {} after {} completed steps",
+                      self.task.name or "default task", len(self.steps))
+        else:
+            _remove(self.path)
+        env.push(journal=self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        env.pop()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            if exc_type is not None:
+                warn("run with --resume to skip {} completed steps",
+                     len(self.steps))
+        if exc_type is None:
+            _remove(self.path)
+
+    def load(self):
+        # Records are pickled one after another; the last one may be
+        # incomplete if the process was killed while writing it.
+        steps = {}
+        try:
+            stream = open(self.path, 'rb')
+        except IOError:
+            return steps
+        try:
+            while True:
+                try:
+                    name, result = pickle.load(stream)
+                except EOFError:
+                    break
+                except Exception:
+                    warn("ignoring damaged tail of {}", self.path)
+                    break
+                steps[name] = result
+        finally:
+            stream.close()
+        return steps
+
+    def record(self, name, result):
+        """Marks the step as completed."""
+        self.steps[name] = result
+        try:
+            data = pickle.dumps((name, result), 2)
+        except (pickle.PicklingError, TypeError):
+            data = pickle.dumps((name, None), 2)
+        if self.fd is None:
+            if not os.path.isdir(self.dir_path):
+                os.makedirs(self.dir_path)
+            self.fd = os.open(self.path,
+                              os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            # Make sure the journal survives a crash of the host.
+            dir_fd = os.open(self.dir_path, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        while data:
+            data = data[os.write(self.fd, data):]
+        os.fsync(self.fd)
+
+
+def step(name, fn, *args, **kwds):
+    """Calls the function unless the step is completed in a resumed run."""
+    journal = env.journal
+    if journal is None:
+        return fn(*args, **kwds)
+    if name in journal.steps:
+        debug("skipping completed step {}", name)
+        return journal.steps[name]
+    result = fn(*args, **kwds)
+    journal.record(name, result)
+    return result
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+import cogs
+cogs.step = step
+
+
+
@@ -0,0 +1,208 @@
+#
+# Copyright (c) 2013, Prometheus Research, LLC
+# Released under MIT license, see `LICENSE` for details.
+#
+
+
+from .core import Failure, env
+from .log import debug, warn, fail
+import sys
+import os
+import time
+import json
+import errno
+import fcntl
+import hashlib
+import cPickle as pickle
+
+
+class TaskLock(object):
+    """Lets only one process execute a task with the same arguments."""
+
+    def __init__(self, task, attrs):
+        self.task = task
+        key = json.dumps([task.name, attrs], sort_keys=True, default=repr)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.dir_path = os.path.join(env.shell.cache_dir, 'locks')
+        self.path = os.path.join(self.dir_path, key+'.lock')
+
+    def run(self, fn, *args):
+        """Call the function holding the lock."""
+        if not os.path.isdir(self.dir_path):
+            os.makedirs(self.dir_path)
+        start = time.time()
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                # The lock must not be inherited by subprocesses.
+                fcntl.fcntl(fd, fcntl.F_SETFD,
+                            fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+                self.acquire(fd, start)
+                record = self.load(fd)
+                if record is not None and record.get('finished', 0) >= start:
+                    # Reuse the outcome of the process we waited for.
+                    return self.replay(record)
+                if not _is_current(fd, self.path):
+                    # The owner removed the lock before releasing it.
+                    continue
+                if record is not None and not _is_alive(record['pid']):
+                    warn("taking over lock {} of dead process {}",
+                         self.path, record['pid'])
+                self.save(fd, {'pid': os.getpid(), 'started': time.time()})
+                try:
+                    return self.execute(fd, fn, args)
+                finally:
+                    # Processes waiting for the lock still read the outcome
+                    # from the file they opened.
+                    try:
+                        os.unlink(self.path)
+                    except OSError:
+                        pass
+            finally:
+                os.close(fd)
+
+    def acquire(self, fd, start):
+        # Wait till the lock is released by other processes.
+        owner = None
+        delay = 0.05
+        while not _try_lock(fd):
+            record = self.load(fd)
+            pid = record['pid'] if record is not None else None
+            if self.task.lock == 'fail':
+                raise fail("task {} with the same arguments"
+                           " is already running (process {})",
+                           self.task.name or "default task", pid)
+            if owner is None or pid != owner:
+                if pid is not None and not _is_alive(pid):
+                    # Must be a subprocess that inherited the lock.
+                    debug("waiting for lock {} held by a subprocess"
+                          " of process {}", self.path, pid)
+                else:
+                    debug("waiting for lock {} held by process {}",
+                          self.path, pid)
+                owner = pid
+            time.sleep(delay)
+            delay = min(delay*2, 1.0)
+        if owner is not None:
+            debug("acquired lock {} in {:.1f} seconds",
+                  self.path, time.time()-start)
+
+    def execute(self, fd, fn, args):
+        # Call the function, record the output and the outcome.
+        output = []
+        streams = sys.stdout, sys.stderr
+        sys.stdout = _Tee(sys.stdout, 'stdout', output)
+        sys.stderr = _Tee(sys.stderr, 'stderr', output)
+        status = 1
+        result = None
+        try:
+            result = fn(*args)
+            status = 0
+            return result
+        except Failure:
+            raise
+        except BaseException:
+            # Let the waiting processes run the task themselves.
+            status = None
+            raise
+        finally:
+            sys.stdout, sys.stderr = streams
+            if status is not None:
+                record = {'pid': os.getpid(), 'finished': time.time(),
+                          'status': status, 'result': result,
+                          'output': output}
+                try:
+                    self.save(fd, record)
+                except (pickle.PicklingError, TypeError):
+                    record['result'] = None
+                    self.save(fd, record)
+
+    def load(self, fd):
+        # Read the owner of the lock and the outcome of the task.
+        os.lseek(fd, 0, os.SEEK_SET)
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        try:
+            record = pickle.loads(b"".join(chunks))
+        except Exception:
+            # Empty or being written.
+            return None
+        if not isinstance(record, dict):
+            return None
+        return record
+
+    def save(self, fd, record):
+        data = pickle.dumps(record, 2)
+        try:
+            os.ftruncate(fd, 0)
+            os.lseek(fd, 0, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+        except OSError, exc:
+            warn("cannot save {}: {}", self.path, exc)
+
+    def replay(self, record):
+        debug("reusing the outcome of process {}", record['pid'])
+        for name, data in record['output']:
+            stream = getattr(sys, name)
+            if not isinstance(data, str):
+                stream = getattr(stream, 'buffer', stream)
+            stream.write(data)
+            stream.flush()
+        if record['status'] != 0:
+            raise Failure()
+        return record['result']
+
+
+class _Tee(object):
+    # Output stream that keeps a copy of the output.  Subprocesses write
+    # to the file descriptors directly, so their output is not copied.
+
+    def __init__(self, stream, name, output):
+        self.stream = stream
+        self.name = name
+        self.output = output
+        if hasattr(stream, 'buffer'):
+            self.buffer = _Tee(stream.buffer, name, output)
+
+    def write(self, data):
+        self.stream.write(data)
+        self.output.append((self.name, data))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _try_lock(fd):
+    # Acquire the lock unless it is held by another process.
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError), exc:
+        if exc.errno not in [errno.EAGAIN, errno.EACCES]:
+            raise
+        return False
+    return True
+
+
+def _is_current(fd, path):
+    # Checks if the file is still linked to the path.
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except OSError:
+        return False
+
+
+def _is_alive(pid):
+    # Checks if the process exists.
+    try:
+        os.kill(pid, 0)
+    except OSError, exc:
+        return (exc.errno == errno.EPERM)
+    return True
+
+
+
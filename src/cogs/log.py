@@ -8,6 +8,8 @@ from .core import Failure, env
 import sys
 import os
 import re
+import time
+import threading
 
 
 class COLORS:
@@ -105,3 +107,81 @@ def prompt(msg):
     return value
 
 
+class progress(object):
+    """Displays progress of a long operation."""
+
+    def __init__(self, msg, total=None, rate=10, interval=10.0, file=None):
+        if file is None:
+            file = sys.stderr
+        self.msg = colorize(msg, file)
+        self.total = total
+        self.file = file
+        self.is_tty = file.isatty()
+        if self.is_tty:
+            self.period = 1.0/rate
+        else:
+            self.period = interval
+        self.count = 0
+        self.start = time.time()
+        # When to draw the next update; not called `next` since 2to3
+        # renames such attributes to `__next__`.
+        self.deadline = self.start+self.period
+        self.lock = threading.Lock()
+        self.is_closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def update(self, count=1):
+        """Add to the number of processed items."""
+        with self.lock:
+            if self.is_closed:
+                return
+            self.count += count
+            if self.total and self.count >= self.total:
+                # Leave the complete state to the final line.
+                return
+            now = time.time()
+            if now >= self.deadline:
+                self.deadline = now+self.period
+                self._draw(now)
+
+    def close(self):
+        """Display the final state."""
+        with self.lock:
+            if self.is_closed:
+                return
+            self.is_closed = True
+            self._draw(time.time(), True)
+
+    def _draw(self, now, is_final=False):
+        elapsed = now-self.start
+        rate = self.count/elapsed if elapsed > 0 else 0.0
+        line = "%s: %s" % (self.msg, self.count)
+        if self.total:
+            line += "/%s (%.1f%%)" % (self.total,
+                                      100.0*self.count/self.total)
+        line += ", %.1f/s" % rate
+        if is_final:
+            line += ", %s" % _to_clock(elapsed)
+        elif self.total and rate > 0 and self.count < self.total:
+            line += ", ETA %s" % _to_clock((self.total-self.count)/rate)
+        if self.is_tty:
+            line = "\r"+line+"\x1b[K"
+            if is_final:
+                line += "\n"
+        else:
+            line += "\n"
+        self.file.write(line)
+        self.file.flush()
+
+
+def _to_clock(seconds):
+    # Formats a time interval as `H:MM:SS`.
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds//3600, seconds//60%60, seconds%60)
+
+
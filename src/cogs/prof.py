@@ -0,0 +1,363 @@
+#
+# Copyright (c) 2013, Prometheus Research, LLC
+# Released under MIT license, see `LICENSE` for details.
+#
+
+
+from .core import env
+from .log import debug, warn, fail, _out
+import sys
+import os.path
+import time
+import signal
+import resource
+import threading
+import traceback
+import cProfile
+import pstats
+try:
+    # Python 3.4+.
+    import tracemalloc
+except ImportError:
+    # Python 2.
+    tracemalloc = None
+try:
+    # Python 3.3+.
+    import faulthandler
+except ImportError:
+    # Python 2.
+    faulthandler = None
+
+
+class Profiler(object):
+    """Collects CPU profile of the enclosed code."""
+
+    is_active = False
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def __enter__(self):
+        Profiler.is_active = True
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.profile.disable()
+        Profiler.is_active = False
+        self.save()
+
+    def save(self):
+        # Dump the profile as configured by the `profile` settings.
+        if not env.profile:
+            return
+        debug("saving profile to {}", env.profile)
+        self.profile.dump_stats(env.profile)
+        stats = pstats.Stats(self.profile, stream=sys.stderr)
+        if env.profile_stacks:
+            debug("saving collapsed stacks to {}", env.profile_stacks)
+            write_stacks(env.profile_stacks, collapse(stats))
+        if env.profile_top:
+            stats.sort_stats('cumulative').print_stats(env.profile_top)
+
+
+class Sampler(object):
+    """Samples call stacks of the enclosed code at regular intervals."""
+
+    is_active = False
+
+    def __init__(self):
+        self.counts = {}
+        self.samples = 0
+        self.overhead = 0.0
+        self.is_done = False
+
+    def __enter__(self):
+        self.is_enabled = bool(env.sample_profile) and not Sampler.is_active
+        if self.is_enabled:
+            Sampler.is_active = True
+            # A thread does not interrupt system calls as a timer signal
+            # would, and it measures the wall clock time, so we see time
+            # spent waiting for subprocesses too.
+            self.ident = threading.current_thread().ident
+            self.interval = 1.0/env.sample_rate
+            self.started = time.time()
+            self.thread = threading.Thread(target=self.loop)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not self.is_enabled:
+            return
+        self.is_done = True
+        self.thread.join()
+        Sampler.is_active = False
+        duration = time.time()-self.started
+        debug("collected {} samples; sampling took {:.2f}% of {:.1f}"
+              " seconds", self.samples,
+              100.0*self.overhead/max(duration, 1e-6), duration)
+        debug("saving sampled stacks to {}", env.sample_profile)
+        write_stacks(env.sample_profile, self.counts)
+
+    def loop(self):
+        while not self.is_done:
+            time.sleep(self.interval)
+            start = time.time()
+            frame = sys._current_frames().get(self.ident)
+            if frame is None:
+                break
+            labels = []
+            while frame is not None:
+                code = frame.f_code
+                labels.append(_label((code.co_filename, code.co_firstlineno,
+                                      code.co_name)))
+                frame = frame.f_back
+            del frame
+            stack = ";".join(reversed(labels))
+            self.counts[stack] = self.counts.get(stack, 0.0)+self.interval
+            self.samples += 1
+            self.overhead += time.time()-start
+
+
+class Watchdog(object):
+    """Dumps stacks when the enclosed code runs longer than expected."""
+
+    def __enter__(self):
+        self.timer = None
+        if not env.watchdog:
+            return self
+        if faulthandler is not None:
+            faulthandler.dump_traceback_later(env.watchdog, repeat=True,
+                                              file=sys.__stderr__)
+        else:
+            self.event = threading.Event()
+            self.timer = threading.Thread(target=self.loop)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not env.watchdog:
+            return
+        if self.timer is None:
+            faulthandler.cancel_dump_traceback_later()
+        else:
+            self.event.set()
+            self.timer.join()
+
+    def loop(self):
+        started = time.time()
+        while not self.event.wait(env.watchdog):
+            sys.__stderr__.write("Timeout (%.1f seconds)!\n"
+                                 % (time.time()-started))
+            dump_stacks()
+
+
+def dump_stacks(signo=None, frame=None):
+    """Prints call stacks of all threads."""
+    # Also serves as a signal handler where `faulthandler` is missing.
+    stream = sys.__stderr__
+    current = threading.current_thread().ident
+    for ident, top in sorted(sys._current_frames().items()):
+        if ident == current:
+            # Skip the frames of the handler itself.
+            if frame is None:
+                continue
+            top = frame
+        stream.write("Thread 0x%x (most recent call first):\n" % ident)
+        for line in reversed(traceback.format_stack(top)):
+            stream.write(line)
+        stream.write("\n")
+    stream.flush()
+
+
+def handle_dump_signal():
+    """Makes `SIGUSR1` print call stacks of all threads."""
+    if threading.current_thread().name != 'MainThread':
+        return
+    if faulthandler is not None:
+        faulthandler.register(signal.SIGUSR1, file=sys.__stderr__,
+                              all_threads=True)
+    else:
+        signal.signal(signal.SIGUSR1, dump_stacks)
+        # Restart system calls interrupted by the signal, so that
+        # a dump does not break blocking reads of the task.
+        signal.siginterrupt(signal.SIGUSR1, False)
+
+
+class MemoryTracker(object):
+    """Reports memory usage of the enclosed code."""
+
+    # How often the memory budget is checked, in seconds.
+    INTERVAL = 0.1
+
+    def __enter__(self):
+        self.snapshot = None
+        self.monitor = None
+        self.is_interrupted = False
+        self.is_raised = False
+        if env.memory_budget and \
+                threading.current_thread().name == 'MainThread':
+            self.budget = env.memory_budget
+            self.thread_id = threading.current_thread().ident
+            self.handler = signal.signal(signal.SIGINT, self.interrupt)
+            self.event = threading.Event()
+            self.monitor = threading.Thread(target=self.loop)
+            self.monitor.daemon = True
+            self.monitor.start()
+        if env.memory:
+            if tracemalloc is None:
+                warn("cannot trace Python allocations:"
+                     " tracemalloc is not available")
+            elif not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.snapshot = tracemalloc.take_snapshot()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if self.monitor is not None:
+            self.event.set()
+            self.monitor.join()
+            signal.signal(signal.SIGINT, self.handler)
+        if not (env.memory or env.memory_budget):
+            return
+        peak = _max_rss(resource.RUSAGE_SELF)
+        children_peak = _max_rss(resource.RUSAGE_CHILDREN)
+        is_over = (env.memory_budget and
+                   max(peak, children_peak) > env.memory_budget)
+        if env.memory or is_over:
+            self.report(peak, children_peak)
+        if self.snapshot is not None:
+            tracemalloc.stop()
+        if is_over and (exc_type is None or self.is_interrupted):
+            raise fail("memory budget of {} exceeded",
+                       _format_size(env.memory_budget))
+
+    def loop(self):
+        # Interrupts the task as soon as it goes over the budget.  Only
+        # the peak size is available on all platforms; subprocesses
+        # are counted when they complete.
+        while not self.event.wait(self.INTERVAL):
+            if self.is_raised:
+                break
+            if not self.is_interrupted:
+                if max(_max_rss(resource.RUSAGE_SELF),
+                       _max_rss(resource.RUSAGE_CHILDREN)) <= self.budget:
+                    continue
+                self.is_interrupted = True
+            # Unlike `interrupt_main()`, a signal also breaks a wait for
+            # a subprocess.  It is repeated till the handler is called in
+            # case it came just before the main thread started to wait.
+            if hasattr(signal, 'pthread_kill'):
+                # Python 3.3+.
+                signal.pthread_kill(self.thread_id, signal.SIGINT)
+            else:
+                # Python 2.
+                os.kill(os.getpid(), signal.SIGINT)
+
+    def interrupt(self, signo, frame):
+        # Raises `KeyboardInterrupt`, only once if over the budget.
+        if self.is_interrupted:
+            if self.is_raised:
+                return
+            self.is_raised = True
+        raise KeyboardInterrupt()
+
+    def report(self, peak, children_peak):
+        _report("Memory usage:")
+        _report("  {:<24} : {}", "peak RSS", _format_size(peak))
+        _report("  {:<24} : {}", "peak RSS of subprocesses",
+                _format_size(children_peak))
+        if self.snapshot is None:
+            return
+        current, traced_peak = tracemalloc.get_traced_memory()
+        _report("  {:<24} : {}", "Python heap", _format_size(current))
+        _report("  {:<24} : {}", "peak Python heap",
+                _format_size(traced_peak))
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ])
+        stats = snapshot.compare_to(self.snapshot, 'lineno')
+        stats = [stat for stat in stats if stat.size_diff > 0][:10]
+        if stats:
+            _report("Top allocation sites:")
+        for stat in stats:
+            frame = stat.traceback[0]
+            _report("  {:>10} in {:>7} blocks : {}:{}",
+                    _format_size(stat.size_diff), stat.count_diff,
+                    frame.filename, frame.lineno)
+
+
+def collapse(stats, threshold=1e-6):
+    """Reconstructs call stacks from profile statistics."""
+    # cProfile only records caller-callee pairs, so we distribute the
+    # time of each function among its call paths in proportion to the
+    # time spent in each caller-callee pair.
+    callees = {}
+    for func in stats.stats:
+        callers = stats.stats[func][4]
+        for caller in callers:
+            callees.setdefault(caller, []).append((func, callers[caller][3]))
+    counts = {}
+    queue = [((func,), stats.stats[func][3])
+             for func in sorted(stats.stats)
+             if not stats.stats[func][4]]
+    while queue:
+        path, time = queue.pop()
+        func = path[-1]
+        cc, nc, tt, ct, callers = stats.stats[func]
+        ratio = time/ct if ct > 0 else 0.0
+        stack = ";".join(_label(item) for item in path)
+        counts[stack] = counts.get(stack, 0.0)+tt*ratio
+        for callee, callee_time in callees.get(func, []):
+            callee_time *= ratio
+            if callee in path or callee_time < threshold:
+                continue
+            queue.append((path+(callee,), callee_time))
+    return counts
+
+
+def write_stacks(path, counts):
+    """Saves stacks with their weights in seconds as collapsed stacks."""
+    stream = open(path, 'w')
+    for stack in sorted(counts):
+        weight = int(round(counts[stack]*1e6))
+        if weight > 0:
+            stream.write("%s %s\n" % (stack, weight))
+    stream.close()
+
+
+def _label(func):
+    # Generates a frame name from a `(filename, lineno, name)` triple.
+    filename, lineno, name = func
+    if filename == '~':
+        return name
+    return "%s (%s:%s)" % (name, os.path.basename(filename), lineno)
+
+
+def _max_rss(who):
+    # Peak resident set size, in bytes.
+    value = resource.getrusage(who).ru_maxrss
+    if sys.platform != 'darwin':
+        value *= 1024
+    return value
+
+
+def _format_size(size):
+    # Formats the number of bytes for humans.
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024.0
+    if unit == 'B':
+        return "%d %s" % (size, unit)
+    return "%.1f %s" % (size, unit)
+
+
+def _report(msg, *args):
+    # Prints a line of a report.
+    _out(msg+"\n", sys.stderr, args, {})
+
+
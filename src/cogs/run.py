@@ -4,11 +4,21 @@
 #
 
 
-from .core import Failure, Environment, env, _to_name
-from .log import warn, debug, fail
+from .core import Failure, Environment, env, _to_name, _exit_status
+from .log import warn, debug, fail, colorize
+from .prof import (Profiler, Sampler, Watchdog, MemoryTracker,
+                   handle_dump_signal)
+from .hist import HistoryRecorder
+from .lock import TaskLock
+from .journal import Journal
 import sys
 import types
 import os.path
+import io
+import tempfile
+import select
+import traceback
+import cPickle as pickle
 try:
     # Python 3.
     import importlib._bootstrap
@@ -17,7 +27,6 @@ except ImportError:
     importlib = None
     import imputil
     imputil._os_stat = os.stat
-import pkg_resources
 import yaml
 
 
@@ -29,46 +38,84 @@ env.add(shell=Environment(name="Cogs",
                           config_dirs=['/etc',
                                        os.path.join(sys.prefix, '/etc'),
                                        os.path.expanduser('~/.cogs'),
-                                       os.path.abspath('.')]),
+                                       os.curdir],
+                          cache_dir=os.path.join(
+                                os.environ.get('XDG_CACHE_HOME') or
+                                os.path.expanduser('~/.cache'),
+                                'cogs'),
+                          registry=None),
         debug=False,
         config_file=None,
+        changes=None,
+        limits={},
+        profile=None,
+        profile_stacks=None,
+        profile_top=0,
+        sample_profile=None,
+        sample_rate=100,
+        watchdog=None,
+        memory=False,
+        memory_budget=None,
+        history=None,
+        settings_snapshot=None,
+        resume=False,
+        journal=None,
+        scratch=None,
+        initialized_settings=set(),
         task_map={},
         setting_map={},
         topic_map={})
 
 
+# Parameters that exist before any settings are initialized.
+_BASE_PARAMS = frozenset(env.__dict__)
+
+
 _DEFAULT = object()
-def _init_setting(name, value=_DEFAULT, seen=set()):
+def _init_setting(name, value=_DEFAULT):
     # Initialize the setting once.
-
-    # Terrible abuse of a mutable default value to prevent the setting from
-    # being initialized more than once.
-    if name in seen:
+    if name in env.initialized_settings:
         return
-    seen.add(name)
+    env.initialized_settings.add(name)
 
     spec = env.setting_map[name]
+    if spec.is_lazy:
+        # Postpone initialization till the first use of the parameter.
+        env.defer(spec.attr, lambda: _call_setting(spec, value))
+    else:
+        _call_setting(spec, value)
+
+
+def _call_setting(spec, value=_DEFAULT):
+    # Run the setting code.
     try:
         if value is not _DEFAULT:
             spec.code(value)
         else:
             spec.code()
     except ValueError, exc:
-        raise fail("invalid value for setting --{}: {}", name, exc)
+        raise fail("invalid value for setting --{}: {}", spec.name, exc)
 
 
-def _load_extensions():
+def _load_extensions(local=True):
     # Load standard tasks and settings.
     __import__('cogs.std')
 
+    # A frozen application knows where extensions are; modules that
+    # define only tasks are imported on demand.
+    if env.shell.registry is not None:
+        for module in env.shell.registry['modules']:
+            __import__(module)
+
     # Load extensions registered using the entry point.
-    if env.shell.entry_point:
+    elif env.shell.entry_point:
+        import pkg_resources
         for entry in pkg_resources.iter_entry_points(env.shell.entry_point):
             debug("loading extensions from {}", entry)
             entry.load()
 
     # Load extensions from the current directory.
-    if env.shell.local_package:
+    if local and env.shell.local_package:
         package = env.shell.local_package
         prefix = os.path.join(os.getcwd(), package)
         module = None
@@ -102,6 +149,22 @@ def _load_extensions():
                 exec code in local.__dict__
 
 
+def _find_task(name):
+    # Find a task by name; in a frozen application, import its module.
+    registry = env.shell.registry
+    if name not in env.task_map and registry is not None and \
+            name in registry['tasks']:
+        __import__(registry['tasks'][name])
+    return env.task_map.get(name)
+
+
+def _load_tasks():
+    # In a frozen application, import modules with all tasks.
+    if env.shell.registry is not None:
+        for name in sorted(env.shell.registry['tasks']):
+            _find_task(name)
+
+
 def _parse_argv(argv):
     # Parse command line parameters.
 
@@ -170,8 +233,8 @@ def _parse_argv(argv):
                     attrs[opt.attr] = value
                 else:
                     if opt.attr not in attrs:
-                        attrs[opt.attr] = []
-                    attrs[opt.attr].append(value)
+                        attrs[opt.attr] = ()
+                    attrs[opt.attr] += (value,)
 
         # Option or a collection of options in short form.
         elif param.startswith('-') and param != '-' and not no_more_opts:
@@ -209,10 +272,9 @@ def _parse_argv(argv):
             if param == '-' and not no_more_opts:
                 task = env.task_map['']
             else:
-                name = _to_name(param)
-                if name not in env.task_map:
+                task = _find_task(_to_name(param))
+                if task is None:
                     raise fail("unknown task {}", param)
-                task = env.task_map[name]
 
         # A task argument.
         else:
@@ -269,11 +331,7 @@ def _parse_argv(argv):
         if opt.attr in attrs:
             if opt.check is not None:
                 try:
-                    if opt.is_plural:
-                        attrs[opt.attr] = tuple(opt.check(value)
-                                                for value in attrs[opt.attr])
-                    else:
-                        attrs[opt.attr] = opt.check(attrs[opt.attr])
+                    attrs[opt.attr] = _check(opt, attrs[opt.attr])
                 except ValueError, exc:
                     raise fail("invalid value for option --{}: {}",
                                opt.name, exc)
@@ -285,11 +343,7 @@ def _parse_argv(argv):
         if arg.attr in attrs:
             if arg.check is not None:
                 try:
-                    if arg.is_plural:
-                        attrs[arg.attr] = tuple(arg.check(value)
-                                                for value in attrs[arg.attr])
-                    else:
-                        attrs[arg.attr] = arg.check(attrs[arg.attr])
+                    attrs[arg.attr] = _check(arg, attrs[arg.attr])
                 except ValueError, exc:
                     raise fail("invalid value for argument <{}>: {}",
                                arg.name, exc)
@@ -299,17 +353,45 @@ def _parse_argv(argv):
     return task, attrs
 
 
+def _check(spec, value):
+    # Validate and transform the value of an argument or an option.
+    if not spec.is_plural:
+        return spec.check(value)
+    if spec.is_batch:
+        # The check gets all values at once; in place of each invalid
+        # value it may return `ValueError`.
+        values = tuple(spec.check(value))
+        if len(values) != len(value):
+            raise ValueError("expected %s values; got %s"
+                             % (len(value), len(values)))
+    else:
+        values = []
+        for item in value:
+            try:
+                values.append(spec.check(item))
+            except ValueError, exc:
+                values.append(exc)
+        values = tuple(values)
+    errors = [str(item) for item in values if isinstance(item, ValueError)]
+    if errors:
+        # Report all invalid values together.
+        message = "; ".join(errors[:10])
+        if len(errors) > 10:
+            message += " (and %s more)" % (len(errors)-10)
+        raise ValueError(message)
+    return values
+
+
 def _configure_environ():
     # Load settings from environment variables.
     prefix = "%s_" % env.shell.name.upper().replace('-', '_')
-    for key in sorted(os.environ):
-        if not key.startswith(prefix):
-            continue
+    for key in sorted(key for key in os.environ
+                      if key.startswith(prefix)):
         name = _to_name(key[len(prefix):])
         if name not in env.setting_map:
             warn("unknown setting {} in the environment", key)
             continue
-        _init_setting(name, os.environ[key])
+        yield name, os.environ[key]
 
 
 try:
@@ -346,30 +428,179 @@ def _configure_file(config_path):
                  key, config_path)
             continue
 
-        _init_setting(name, data[key])
+        yield name, data[key]
 
 
 def _configure():
     # Load and initialize settings.
-
-    # Load settings from the process environment.
-    _configure_environ()
-
-    # Load settings from configuration files.
     if env.config_file:
         if not os.path.isfile(env.config_file):
             raise fail('specified configuration file {} does not exist',
                        env.config_file)
-        _configure_file(env.config_file)
+
+    # Reuse the settings resolved by the parent process if it has
+    # the same configuration.
+    fingerprint = _fingerprint()
+    snapshot = _load_snapshot(fingerprint)
+    if snapshot is not None:
+        for name, attrs in snapshot['attrs']:
+            if name in env.initialized_settings:
+                continue
+            env.initialized_settings.add(name)
+            for key, value in attrs:
+                if key in env.__dict__:
+                    env.set(**{key: value})
+                else:
+                    env.add(**{key: value})
+        for name, value in snapshot['values']:
+            _init_setting(name, value)
+        for name in sorted(env.setting_map):
+            _init_setting(name)
+        return
+
+    # Load settings from the process environment and configuration
+    # files; the first value of a setting wins.
+    values = list(_configure_environ())
+    config_paths = _config_paths()
+    for config_path in config_paths:
+        values.extend(_configure_file(config_path))
+    names = set()
+    snapshot = {'fingerprint': fingerprint, 'attrs': [], 'values': []}
+    for name, value in values:
+        if name in names:
+            continue
+        names.add(name)
+        _record_setting(snapshot, name, value)
+
+    # Initialize the remaining settings.
+    for name in sorted(env.setting_map):
+        if name not in names:
+            _record_setting(snapshot, name)
+
+    # Without configuration files, there is little to save for
+    # the child processes.
+    if not config_paths:
+        snapshot = None
+    else:
+        snapshot = dict(snapshot, path=None, pid=None)
+    env.set(settings_snapshot=snapshot)
+
+
+def _record_setting(snapshot, name, value=_DEFAULT):
+    # Initialize the setting, remember the parameters it changed.
+    spec = env.setting_map[name]
+    if name in env.initialized_settings or spec.is_lazy:
+        # Given on the command line or initialized on demand; the child
+        # process initializes it itself.
+        _init_setting(name, value)
+        if value is not _DEFAULT:
+            snapshot['values'].append((name, value))
+        return
+    before = env.__dict__.copy()
+    _init_setting(name, value)
+    attrs = [(key, env.__dict__[key]) for key in sorted(env.__dict__)
+             if key not in before or before[key] is not env.__dict__[key]
+                or key == spec.attr]
+    try:
+        pickle.dumps(attrs, 2)
+    except Exception:
+        if value is not _DEFAULT:
+            snapshot['values'].append((name, value))
+        return
+    snapshot['attrs'].append((name, attrs))
+
+
+def _config_paths():
+    # Configuration files in the order of precedence.
+    paths = []
+    if env.config_file and os.path.isfile(env.config_file):
+        paths.append(env.config_file)
     if env.shell.config_name and env.shell.config_dirs:
         for config_dir in reversed(env.shell.config_dirs):
-            config_path = os.path.join(config_dir, env.shell.config_name)
+            config_path = os.path.join(os.path.abspath(config_dir),
+                                       env.shell.config_name)
             if os.path.isfile(config_path):
-                _configure_file(config_path)
+                paths.append(config_path)
+    return paths
 
-    # Initialize the remaining settings.
-    for name in sorted(env.setting_map):
-        _init_setting(name)
+
+def _snapshot_var():
+    # The environment variable with the path to the settings snapshot.
+    return "_%s_SETTINGS" % env.shell.name.upper().replace('-', '_')
+
+
+def _fingerprint():
+    # Inputs that determine the values of settings.
+    prefix = "%s_" % env.shell.name.upper().replace('-', '_')
+    files = []
+    for path in _config_paths():
+        st = os.stat(path)
+        files.append((os.path.abspath(path), st.st_size, st.st_mtime))
+    return (sorted(env.setting_map), files,
+            sorted((key, os.environ[key]) for key in os.environ
+                   if key.startswith(prefix)))
+
+
+def _load_snapshot(fingerprint):
+    # Load settings saved by the parent process.
+    path = os.environ.get(_snapshot_var())
+    if not path:
+        return None
+    try:
+        stream = open(path, 'rb')
+        try:
+            if os.fstat(stream.fileno()).st_uid != os.getuid():
+                return None
+            snapshot = pickle.load(stream)
+        finally:
+            stream.close()
+    except Exception:
+        return None
+    if not isinstance(snapshot, dict) or \
+            snapshot.get('fingerprint') != fingerprint:
+        return None
+    debug("loading settings from {}", path)
+    # Children of this process get the same file.
+    env.set(settings_snapshot=dict(snapshot, path=path, pid=None))
+    return snapshot
+
+
+def _export_settings():
+    # Save the settings for a child process; called before a process
+    # is spawned.
+    snapshot = env.settings_snapshot
+    if snapshot is None or snapshot['path'] is not None:
+        return
+    try:
+        fd, path = tempfile.mkstemp(prefix='cogs-settings-')
+        stream = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump({'fingerprint': snapshot['fingerprint'],
+                         'attrs': snapshot['attrs'],
+                         'values': snapshot['values']},
+                        stream, 2)
+        finally:
+            stream.close()
+    except (IOError, OSError, pickle.PicklingError), exc:
+        debug("cannot save settings: {}", exc)
+        return
+    snapshot['path'] = path
+    snapshot['pid'] = os.getpid()
+    os.environ[_snapshot_var()] = path
+
+
+def _remove_settings():
+    # Remove the settings saved by this process.
+    snapshot = env.settings_snapshot
+    if snapshot is None or snapshot['pid'] != os.getpid():
+        return
+    try:
+        os.unlink(snapshot['path'])
+    except OSError:
+        pass
+    if os.environ.get(_snapshot_var()) == snapshot['path']:
+        del os.environ[_snapshot_var()]
+    snapshot['path'] = snapshot['pid'] = None
 
 
 def run(argv):
@@ -383,6 +614,139 @@ def run(argv):
     _configure()
 
     # Execute the task.
+    try:
+        with HistoryRecorder(task, attrs) as recorder, MemoryTracker(), \
+                Watchdog(), Sampler():
+            if env.profile and not Profiler.is_active:
+                with Profiler():
+                    recorder.result = _execute(task, attrs)
+            else:
+                recorder.result = _execute(task, attrs)
+            return recorder.result
+    finally:
+        _remove_settings()
+
+
+class Invocation(object):
+    """Outcome of a task executed with `invoke()`."""
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.result = None
+        self.failure = None
+        self.output = ""
+        self.errors = ""
+
+    @property
+    def status(self):
+        if self.failure is not None:
+            return 1
+        return _exit_status(self.result)
+
+    def __repr__(self):
+        return "<%s %s: %s>" % (self.__class__.__name__,
+                                " ".join(self.argv),
+                                "failed" if self.failure is not None
+                                else "ok")
+
+
+def invoke(argv, cwd=None, environ=None):
+    """Executes a task in an isolated environment, captures the output."""
+    # Extensions that register tasks when imported must be loaded
+    # before we make a private copy of the registry.
+    _load_extensions(local=False)
+    invocation = Invocation(list(argv))
+    saved_cwd = os.getcwd()
+    saved_environ = os.environ.copy()
+    saved_streams = sys.stdout, sys.stderr
+    saved_argv = sys.argv
+    saved_module = sys.modules.get(env.shell.local_package)
+    out = _capture()
+    err = _capture()
+    try:
+        if cwd:
+            os.chdir(cwd)
+        if environ:
+            os.environ.update(environ)
+        sys.argv = [env.shell.name.lower()]+invocation.argv
+        sys.stdout, sys.stderr = out, err
+        # Parameters added by settings of the enclosing task are going
+        # to be added again.
+        added = [spec.attr for spec in env.setting_map.values()
+                 if spec.attr not in _BASE_PARAMS]
+        # Forget tasks and settings defined in the current directory.
+        with env(initialized_settings=set(),
+                 task_map=_filter_local(env.task_map),
+                 setting_map=_filter_local(env.setting_map),
+                 topic_map=_filter_local(env.topic_map)):
+            env.remove(*added)
+            try:
+                invocation.result = run(sys.argv)
+            except Failure, exc:
+                invocation.failure = exc
+    finally:
+        out.flush()
+        err.flush()
+        sys.stdout, sys.stderr = saved_streams
+        sys.argv = saved_argv
+        if env.shell.local_package:
+            # The module is replaced when extensions are loaded.
+            if saved_module is not None:
+                sys.modules[env.shell.local_package] = saved_module
+            else:
+                sys.modules.pop(env.shell.local_package, None)
+        os.environ.clear()
+        os.environ.update(saved_environ)
+        os.chdir(saved_cwd)
+    invocation.output = _captured(out)
+    invocation.errors = _captured(err)
+    return invocation
+
+
+def _filter_local(spec_map):
+    # Copy the registry except for local extensions.
+    return dict((name, spec) for name, spec in spec_map.items()
+                if getattr(spec.code, '__module__', None) !=
+                        env.shell.local_package)
+
+
+def _capture():
+    # Make a text stream that collects the output.
+    if sys.version_info[0] >= 3:
+        # Python 3; keep the underlying binary buffer in sync.
+        return io.TextIOWrapper(io.BytesIO(), encoding='utf-8',
+                                errors='replace', write_through=True)
+    # Python 2.
+    return io.BytesIO()
+
+
+def _captured(stream):
+    # Get the collected output.
+    data = getattr(stream, 'buffer', stream).getvalue()
+    if not isinstance(data, str):
+        data = data.decode('utf-8', 'replace')
+    return data
+
+
+def _execute(task, attrs):
+    # Execute the task, unless it is already running.
+    if task.lock is not None:
+        return TaskLock(task, attrs).run(_dispatch, task, attrs)
+    return _dispatch(task, attrs)
+
+
+def _dispatch(task, attrs):
+    # Execute the task, in parallel if it has a sharded argument.
+    with Journal(task, attrs):
+        for arg in task.args:
+            if (arg.is_sharded and len(attrs[arg.attr] or ()) > 1 and
+                    env.jobs > 1):
+                return _execute_sharded(task, attrs, arg)
+        return _call(task, attrs)
+
+
+def _call(task, attrs):
+    # Create a task instance and call it.
     try:
         instance = task.code(**attrs)
     except ValueError, exc:
@@ -390,15 +754,181 @@ def run(argv):
     return instance()
 
 
+def _execute_sharded(task, attrs, arg):
+    # Split values of the argument between worker processes.
+    values = tuple(attrs[arg.attr])
+    count = min(env.jobs, len(values))
+    debug("running {} in {} shards", task.name or "default task", count)
+    workers = []
+    try:
+        start = 0
+        for idx in range(count):
+            end = start+len(values)//count+(idx < len(values)%count)
+            shard_attrs = attrs.copy()
+            shard_attrs[arg.attr] = values[start:end]
+            start = end
+            prefix = "[%s/%s] " % (idx+1, count)
+            workers.append(_Worker(prefix, _call, task, shard_attrs))
+        _Worker.relay(workers)
+    finally:
+        for worker in workers:
+            worker.wait()
+    failures = [worker for worker in workers if worker.status != 0]
+    if failures:
+        raise fail("{} of {} shards failed", len(failures), count)
+    # The result of a task is its exit status; pass on the first one
+    # that is not a success.
+    for worker in workers:
+        if _exit_status(worker.result) != 0:
+            return worker.result
+    return None
+
+
+class _Worker(object):
+    # Calls a function in a forked process; relays the output and
+    # passes back the result.
+
+    def __init__(self, prefix, fn, *args):
+        self.prefix = prefix
+        self.status = None
+        self.result = None
+        self.data = []
+        out_fd, out_wfd = os.pipe()
+        err_fd, err_wfd = os.pipe()
+        res_fd, res_wfd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                os.close(out_fd)
+                os.close(err_fd)
+                os.close(res_fd)
+                os.dup2(out_wfd, 1)
+                os.dup2(err_wfd, 2)
+                # The streams may be replaced, e.g., by `invoke()`.
+                sys.stdout = _fd_stream(1)
+                sys.stderr = _fd_stream(2)
+                status = 1
+                result = None
+                try:
+                    result = fn(*args)
+                    status = 0
+                except Failure:
+                    pass
+                except BaseException:
+                    traceback.print_exc()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                try:
+                    data = pickle.dumps((status, result), 2)
+                except Exception:
+                    traceback.print_exc()
+                    data = pickle.dumps((1, None), 2)
+                while data:
+                    data = data[os.write(res_wfd, data):]
+            finally:
+                _remove_settings()
+                os._exit(0)
+        os.close(out_wfd)
+        os.close(err_wfd)
+        os.close(res_wfd)
+        self.fds = {out_fd: sys.stdout, err_fd: sys.stderr, res_fd: None}
+
+    @staticmethod
+    def relay(workers):
+        # Copy the output of the workers line by line, adding prefixes.
+        owners = {}
+        tails = {}
+        for worker in workers:
+            for fd in worker.fds:
+                owners[fd] = worker
+                tails[fd] = b''
+        while owners:
+            for fd in select.select(list(owners), [], [])[0]:
+                worker = owners[fd]
+                file = worker.fds[fd]
+                chunk = os.read(fd, 65536)
+                if file is None:
+                    if chunk:
+                        worker.data.append(chunk)
+                        continue
+                else:
+                    lines = (tails[fd]+chunk).split(b'\n')
+                    tails[fd] = lines.pop() if chunk else b''
+                    if not chunk and lines[-1] == b'':
+                        lines.pop()
+                    worker.write(file, lines)
+                    if chunk:
+                        continue
+                os.close(fd)
+                del owners[fd]
+                del worker.fds[fd]
+
+    def write(self, file, lines):
+        if not lines:
+            return
+        prefix = colorize(":debug:`%s`" % self.prefix, file)
+        if not isinstance(prefix, bytes):
+            prefix = prefix.encode('utf-8')
+        stream = getattr(file, 'buffer', file)
+        stream.write(b''.join(prefix+line+b'\n' for line in lines))
+        stream.flush()
+
+    def wait(self):
+        if self.status is not None:
+            return
+        for fd in self.fds:
+            os.close(fd)
+        self.fds.clear()
+        os.waitpid(self.pid, 0)
+        try:
+            self.status, self.result = pickle.loads(b''.join(self.data))
+        except Exception:
+            self.status = 1
+
+
+def _fd_stream(fd):
+    # Make a text stream that writes to the file descriptor.
+    if sys.version_info[0] >= 3:
+        # Python 3.
+        return io.open(fd, 'w', buffering=1, encoding='utf-8',
+                       errors='replace', closefd=False)
+    # Python 2.
+    return os.fdopen(os.dup(fd), 'w')
+
+
+def _peek_setting(name):
+    # Find the value of a setting before the settings are loaded.
+    prefix = "%s_" % env.shell.name.upper().replace('-', '_')
+    value = os.environ.get(prefix+name.upper().replace('-', '_'))
+    params = sys.argv[1:]
+    while params:
+        param = params.pop(0)
+        if param == '--':
+            break
+        if param == '--'+name and params:
+            value = params.pop(0)
+        elif param.startswith('--%s=' % name):
+            value = param.split('=', 1)[1]
+    return value
+
+
 def main():
     """Loads configuration, parses parameters and executes a task."""
     with env():
+        # Let the user see what a stuck process is doing.
+        handle_dump_signal()
         # Enable debugging early if we are certain it's turned on.
         debug_var = '%s_DEBUG' % env.shell.name.upper().replace('-', '_')
         if (os.environ.get(debug_var) in ['true', '1'] or
                 (len(sys.argv) > 1 and sys.argv[1] == '--debug')):
             env.set(debug=True)
         try:
+            if _peek_setting('profile'):
+                # Start profiling early to cover loading extensions.
+                with Profiler():
+                    return run(sys.argv)
             return run(sys.argv)
         except (Failure, IOError, KeyboardInterrupt), exc:
             if env.debug:
@@ -406,3 +936,9 @@ def main():
             return exc
 
 
+import cogs
+cogs.invoke = invoke
+cogs.Invocation = Invocation
+
+
+
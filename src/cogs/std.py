@@ -4,10 +4,21 @@
 #
 
 
-from .core import env, task, default_task, setting, argument, option
-from .log import log, fail
+from .core import (Failure, env, task, default_task, setting, lazy_setting,
+                   argument, option, _to_name)
+from .log import log, debug, fail
+from .fs import watch, cpu_count
+from .run import _parse_argv, _execute, _load_tasks, _remove_settings
+from .hist import History, _versions
 import sys
 import os.path
+import re
+import shutil
+import zipfile
+import tempfile
+import time
+import signal
+import traceback
 
 
 @default_task
@@ -55,6 +66,7 @@ class HELP(object):
         self.topic = topic
 
     def __call__(self):
+        _load_tasks()
         if self.topic is None:
             return self.describe_all()
         if self.topic in env.task_map and self.topic != '':
@@ -202,6 +214,292 @@ class HELP(object):
         spec.code()
 
 
+@task
+class WATCH(object):
+    """rerun a task whenever files change
+
+    Runs the given task, then waits for changes in files matching
+    the `--path` patterns (by default, any file in the current
+    directory) and runs the task again.  If files change while the
+    task is still running, the task is interrupted and restarted.
+
+    To pass options to the task, separate the task from the options
+    of `watch` with `--`:
+
+        cogs watch --path='src/*.py' -- build --verbose
+
+    The task could find the list of changed files in `env.changes`.
+    """
+
+    path = option(key='p', default=(), plural=True, value_name='glob',
+                  hint="watch files matching the pattern")
+    task = argument()
+    arguments = argument(default=(), plural=True)
+
+    def __init__(self, path, task, arguments):
+        self.paths = list(path) or [os.curdir]
+        self.argv = [sys.argv[0], task]+list(arguments)
+
+    def __call__(self):
+        task, attrs = _parse_argv(self.argv)
+        # Make sure the task does not outlive us.
+        handler = signal.signal(signal.SIGTERM, self.terminate)
+        pid = self.start(task, attrs, ())
+        try:
+            for changes in watch(self.paths):
+                self.stop(pid)
+                debug("{} changed", ", ".join(changes))
+                log("`rerunning {}`", self.argv[1] or "default task")
+                pid = self.start(task, attrs, changes)
+        finally:
+            self.stop(pid)
+            signal.signal(signal.SIGTERM, handler)
+
+    def start(self, task, attrs, changes):
+        # Run the task in a forked process with its own process group.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.setpgid(0, 0)
+                with env(changes=tuple(changes)):
+                    _execute(task, attrs)
+                status = 0
+            except (Failure, SystemExit):
+                # `SystemExit` is raised by `terminate()` when the task
+                # is stopped; the handler is inherited from the parent.
+                pass
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                _remove_settings()
+                os._exit(status)
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        return pid
+
+    def stop(self, pid):
+        # Terminate the task and all its subprocesses.
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        os.waitpid(pid, 0)
+
+    def terminate(self, signo, frame):
+        raise SystemExit(1)
+
+
+@task
+class STATS(object):
+    """show statistics of past task runs
+
+    For each task in the history database, displays the number of
+    runs, the median, the 95th and the 99th percentile of run time,
+    and the trend: how the median time of the last 10 runs compares
+    to the median time of the earlier runs.
+
+    When `<task>` is given, also lists recent runs of the task that
+    were much slower than the runs before them.
+
+    Use setting `history` to enable the history database.
+    """
+
+    task = argument(default=None)
+
+    # That many recent runs are used to estimate the trend.
+    RECENT = 10
+    # A run is slow if it is that much slower than the median.
+    SLOW = 1.5
+
+    def __init__(self, task):
+        self.task = task
+
+    def __call__(self):
+        if not env.history:
+            raise fail("the history database is not enabled;"
+                       " use setting `history`")
+        runs = History(env.history).runs(self.task)
+        if not runs:
+            log("No runs recorded.")
+            return
+        by_task = {}
+        for run in runs:
+            by_task.setdefault(run['task'], []).append(run)
+        log("{:<24} {:>6} {:>9} {:>9} {:>9} {:>7}",
+            "Task", "Runs", "p50", "p95", "p99", "Trend")
+        for name in sorted(by_task):
+            times = [run['duration'] for run in by_task[name]]
+            trend = "-"
+            if len(times) >= 2*self.RECENT:
+                before = self.percentile(times[:-self.RECENT], 50)
+                after = self.percentile(times[-self.RECENT:], 50)
+                if before > 0:
+                    trend = "%+.0f%%" % (100.0*(after-before)/before)
+            log("{:<24} {:>6} {:>9} {:>9} {:>9} {:>7}",
+                name or "(default)", len(times),
+                self.format(self.percentile(times, 50)),
+                self.format(self.percentile(times, 95)),
+                self.format(self.percentile(times, 99)),
+                trend)
+        if self.task is None:
+            return
+        runs = by_task.get(self.task, [])
+        slow = []
+        for idx in range(max(self.RECENT, len(runs)-self.RECENT), len(runs)):
+            baseline = self.percentile([run['duration']
+                                        for run in runs[:idx]], 50)
+            if runs[idx]['duration'] > self.SLOW*baseline:
+                slow.append((runs[idx], baseline))
+        if slow:
+            log()
+            log("Slow runs:")
+        for run, baseline in slow:
+            log("  {} {:>9} (baseline {}, exit {}): {}",
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.localtime(run['started'])),
+                self.format(run['duration']), self.format(baseline),
+                run['status'], run['arguments'])
+
+    def percentile(self, values, rank):
+        values = sorted(values)
+        idx = max(int(-(-rank*len(values)//100))-1, 0)
+        return values[idx]
+
+    def format(self, seconds):
+        if seconds < 60:
+            return "%.2fs" % seconds
+        return "%d:%02d" % (seconds//60, seconds%60)
+
+
+@task
+class FREEZE(object):
+    """bundle the application into an executable file
+
+    Creates a Python ZIP application which contains Cogs, the installed
+    extensions and packages given with `--package`.  With `--local`,
+    extensions from the current directory are included too.
+
+    The application contains compiled code and a list of tasks and
+    settings, so it does not need to look for extensions on startup.
+    It could be copied to a host with the same version of Python and
+    executed directly:
+
+        cogs freeze --local build.pyz
+        ./build.pyz build
+    """
+
+    package = option(key='p', default=(), plural=True, value_name='name',
+                     hint="include the package")
+    local = option(hint="include extensions from the current directory")
+    output = argument()
+
+    MAIN = """\
+import sys
+# Namespace package declarations may have imported `cogs` already.
+for name in list(sys.modules):
+    if name == 'cogs' or name.startswith('cogs.'):
+        del sys.modules[name]
+from cogs.run import main, env
+env.shell.set(registry=%r)
+if %r:
+    env.shell.set(local_package=None)
+sys.exit(main())
+"""
+
+    def __init__(self, package, local, output):
+        self.packages = list(package)
+        self.local = local
+        self.output = output
+
+    def __call__(self):
+        _load_tasks()
+        local_package = env.shell.local_package
+        local_path = None
+        if self.local and local_package:
+            prefix = os.path.join(os.getcwd(), local_package)
+            for path in [prefix+'.py', prefix]:
+                if os.path.exists(path):
+                    local_path = path
+        # Find modules that define tasks, settings and topics.
+        registry = {'modules': set(), 'tasks': {},
+                    'versions': _versions()}
+        packages = set(self.packages+['yaml'])
+        for spec_map in [env.task_map, env.setting_map, env.topic_map]:
+            for name in sorted(spec_map):
+                module = spec_map[name].code.__module__
+                if module == local_package:
+                    if local_path is None:
+                        continue
+                    module = 'cogs.local'
+                if spec_map is env.task_map and name:
+                    registry['tasks'][name] = module
+                elif module != 'cogs.std':
+                    registry['modules'].add(module)
+                packages.add(module.split('.')[0])
+        registry['modules'] = sorted(registry['modules'])
+        packages.discard('cogs')
+        stream = open(self.output, 'wb')
+        stream.write(("#!/usr/bin/env python%s.%s\n"
+                      % sys.version_info[:2]).encode('ascii'))
+        archive = zipfile.PyZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            archive.writestr('__main__.py',
+                             self.MAIN % (registry, local_path is not None))
+            # `cogs` is a namespace package which could be installed
+            # in several places; in the archive, it is a plain package.
+            archive.writestr('cogs/__init__.py', "")
+            import cogs
+            for root in cogs.__path__:
+                self.add_tree(archive, root, 'cogs')
+            for name in sorted(packages):
+                try:
+                    module = __import__(name)
+                except ImportError:
+                    raise fail("cannot find package {}", name)
+                path = getattr(module, '__file__', None)
+                if path is None:
+                    raise fail("cannot include package {}", name)
+                if os.path.splitext(os.path.basename(path))[0] == \
+                        '__init__':
+                    archive.writepy(os.path.dirname(path))
+                else:
+                    archive.writepy(os.path.splitext(path)[0]+'.py')
+            if local_path is not None:
+                # Rename `cogs.local.py` to `cogs/local.py`.
+                tmp_path = os.path.join(tmp_dir, 'local')
+                if os.path.isdir(local_path):
+                    shutil.copytree(local_path, tmp_path)
+                else:
+                    tmp_path += '.py'
+                    shutil.copy(local_path, tmp_path)
+                archive.writepy(tmp_path, 'cogs')
+        finally:
+            archive.close()
+            stream.close()
+            shutil.rmtree(tmp_dir)
+        os.chmod(self.output, 0o755)
+        log("created {} with {} tasks", self.output,
+            len(registry['tasks']))
+
+    def add_tree(self, archive, root, base):
+        # Add modules of a package directory.
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if os.path.isdir(path):
+                if os.path.exists(os.path.join(path, '__init__.py')):
+                    archive.writepy(path, base)
+            elif name.endswith('.py') and name != '__init__.py':
+                archive.writepy(path, base)
+
+
 @setting
 def DEBUG(value=False):
     """print debug information"""
@@ -222,3 +520,255 @@ def CONFIG(config_file=None):
     env.set(config_file=config_file)
 
 
+@lazy_setting
+def JOBS(count=None):
+    """number of parallel jobs (default: number of CPUs)"""
+    if count is None or count == '':
+        count = cpu_count()
+    if isinstance(count, str) and count.isdigit():
+        count = int(count)
+    if not (isinstance(count, int) and not isinstance(count, bool) and
+            count > 0):
+        raise ValueError("jobs: expected a positive integer; got %r"
+                         % count)
+    env.add(jobs=count)
+
+
+@setting
+def HISTORY(path=None):
+    """record task runs in a database
+
+    Records every run of a task with its arguments, run time, CPU time
+    of subprocesses and exit status in the given SQLite database.
+    Records are written in batches; those older than 180 days are
+    pruned.  Use task `stats` to analyze the recorded runs.
+    """
+    if not (path is None or isinstance(path, str)):
+        raise ValueError("history: expected a path; got %r" % path)
+    env.set(history=path or None)
+
+
+@setting
+def RESUME(value=False):
+    """skip steps completed by the last failed run
+
+    Tasks mark completed steps with `step()`.  When a task fails, the
+    completed steps are kept in a journal under `~/.cache/cogs`, so
+    the next run of the task with the same arguments and this setting
+    enabled skips them.  The journal is removed when the task succeeds.
+    """
+    if value is None or value in ['false', '', '0', 0]:
+        value = False
+    if value in ['true', '1', 1]:
+        value = True
+    if not isinstance(value, bool):
+        raise ValueError("resume: expected a Boolean value; got %r" % value)
+    env.set(resume=value)
+
+
+@setting
+def LIMITS(limits=None):
+    """default limits for shell commands
+
+    Limits the time and resources available to commands started with
+    `sh()`, `pipe()` and `exe()`.  Specify limits as a comma-separated
+    list of `<limit>=<value>` pairs, or, in a configuration file, as a
+    mapping:
+
+        limits: {timeout: 3600, mem-limit: 4G, nice: 10}
+
+    Supported limits:
+
+        timeout                  : wall clock time, in seconds
+        cpu-limit                : CPU time, in seconds
+        mem-limit                : address space size, in bytes
+                                   (with optional K, M or G suffix)
+        nice                     : niceness increment
+    """
+    if limits is None or limits == '':
+        limits = {}
+    if isinstance(limits, str):
+        pairs = {}
+        for pair in limits.split(','):
+            if '=' not in pair:
+                raise ValueError("limits: expected <limit>=<value>; got %r"
+                                 % pair)
+            key, value = pair.split('=', 1)
+            pairs[key.strip()] = value.strip()
+        limits = pairs
+    if not isinstance(limits, dict):
+        raise ValueError("limits: expected a mapping; got %r" % limits)
+    checks = {
+            'timeout': float,
+            'cpu-limit': int,
+            'mem-limit': _to_size,
+            'nice': int,
+    }
+    values = {}
+    for key in sorted(limits):
+        name = _to_name(str(key))
+        if name not in checks:
+            raise ValueError("limits: unknown limit %r" % key)
+        try:
+            value = checks[name](limits[key])
+        except (TypeError, ValueError):
+            value = None
+        if value is None or value < 0:
+            raise ValueError("limits: invalid value for %s: %r"
+                             % (name, limits[key]))
+        values[name.replace('-', '_')] = value
+    env.set(limits=values)
+
+
+@setting
+def MEMORY(value=False):
+    """report memory usage of the task
+
+    When the task completes, reports the peak resident set size of the
+    process and its subprocesses.  On Python 3.4+, Python allocations
+    are traced too and the report lists the code that allocated most
+    of the memory retained by the task.
+    """
+    if value is None or value in ['false', '', '0', 0]:
+        value = False
+    if value in ['true', '1', 1]:
+        value = True
+    if not isinstance(value, bool):
+        raise ValueError("memory: expected a Boolean value; got %r" % value)
+    env.set(memory=value)
+
+
+@setting
+def MEMORY_BUDGET(size=None):
+    """fail if the task uses more memory
+
+    Makes the task fail with a memory report if the peak resident set
+    size of the process or any of its subprocesses exceeds the given
+    number of bytes (with optional K, M or G suffix).  The process is
+    checked while the task runs and interrupted as soon as it goes
+    over the budget; subprocesses are checked when they complete.
+    """
+    if size is None or size == '':
+        size = None
+    else:
+        try:
+            size = _to_size(size)
+        except ValueError:
+            raise ValueError("memory-budget: expected a size; got %r"
+                             % size)
+    env.set(memory_budget=size)
+
+
+def _to_size(value):
+    # Converts `"512M"`, `"4G"`, etc to the number of bytes.
+    if isinstance(value, str):
+        match = re.match(r'^\s*(\d+)\s*([kKmMgGtT]?)[bB]?\s*$', value)
+        if match is None:
+            raise ValueError(value)
+        number, suffix = match.groups()
+        return int(number) * 1024**' KMGT'.index((suffix or ' ').upper())
+    if isinstance(value, bool) or not isinstance(value, (int, long)):
+        raise ValueError(value)
+    return value
+
+
+@setting
+def PROFILE(path=None):
+    """save CPU profile of the task to a file
+
+    Runs the task under the Python profiler and saves the collected
+    statistics to the given file, which could be examined with the
+    `pstats` module.  When the setting is given on the command line or
+    in the environment, loading of extensions and configuration is
+    profiled too.
+
+    See also settings `profile-stacks` and `profile-top`.
+    """
+    if not (path is None or isinstance(path, str)):
+        raise ValueError("profile: expected a path; got %r" % path)
+    env.set(profile=path or None)
+
+
+@setting
+def PROFILE_STACKS(path=None):
+    """save profiled call stacks for flame graph tools
+
+    Saves the profile collected with `--profile` as a list of call
+    stacks in the collapsed format understood by flame graph tools.
+    The stacks are reconstructed from caller-callee timings, so they
+    are not exact when a function is called from several places.
+    """
+    if not (path is None or isinstance(path, str)):
+        raise ValueError("profile-stacks: expected a path; got %r" % path)
+    env.set(profile_stacks=path or None)
+
+
+@setting
+def PROFILE_TOP(count=None):
+    """print N top functions from the profile"""
+    if count is None or count == '':
+        count = 0
+    if isinstance(count, str) and count.isdigit():
+        count = int(count)
+    if not (isinstance(count, int) and not isinstance(count, bool) and
+            count >= 0):
+        raise ValueError("profile-top: expected a non-negative integer;"
+                         " got %r" % count)
+    env.set(profile_top=count)
+
+
+@setting
+def SAMPLE_PROFILE(path=None):
+    """save sampled call stacks of the task to a file
+
+    Samples the call stack of the task at regular intervals and saves
+    the stacks in the collapsed format understood by flame graph tools.
+    Unlike `--profile`, sampling does not slow down the task noticeably,
+    and it shows time spent waiting for subprocesses too.
+
+    See also setting `sample-rate`.
+    """
+    if not (path is None or isinstance(path, str)):
+        raise ValueError("sample-profile: expected a path; got %r" % path)
+    env.set(sample_profile=path or None)
+
+
+@setting
+def SAMPLE_RATE(rate=None):
+    """number of stack samples per second (default: 100)"""
+    if rate is None or rate == '':
+        rate = 100
+    if isinstance(rate, str) and rate.isdigit():
+        rate = int(rate)
+    if not (isinstance(rate, int) and not isinstance(rate, bool) and
+            0 < rate <= 10000):
+        raise ValueError("sample-rate: expected a positive integer;"
+                         " got %r" % rate)
+    env.set(sample_rate=rate)
+
+
+@setting
+def WATCHDOG(timeout=None):
+    """print call stacks if the task runs too long
+
+    Prints call stacks of all threads to `stderr` every time the task
+    has been running for the given number of seconds.  Call stacks of
+    a running task could also be printed on demand by sending it the
+    `SIGUSR1` signal.
+    """
+    if timeout is None or timeout == '':
+        timeout = None
+    else:
+        try:
+            if isinstance(timeout, bool):
+                raise ValueError(timeout)
+            seconds = float(timeout)
+            if not seconds > 0:
+                raise ValueError(timeout)
+        except (TypeError, ValueError):
+            raise ValueError("watchdog: expected a positive number;"
+                             " got %r" % timeout)
+        timeout = seconds
+    env.set(watchdog=timeout)
+
+
@@ -0,0 +1,377 @@
+#
+# Tasks exercised by the regression tests.
+#
+
+
+from cogs import env, task, argument, option, invoke, step, lazy_setting
+from cogs.log import log, fail, progress
+from cogs.fs import (read, write, mktree, sh, pipe, exe, pipeline, stage,
+        session, plan, scratch, watch, digest, sync, find, pack, unpack)
+import sys
+import os
+import stat
+import time
+import threading
+
+
+@task
+class Shard(object):
+    """process values in parallel shards"""
+
+    values = argument(plural=True, sharded=True)
+    echo = option(hint="print the values")
+
+    def __init__(self, values, echo):
+        self.values = values
+        self.echo = echo
+
+    def __call__(self):
+        for value in self.values:
+            if value == 'fail':
+                raise fail("cannot process {}", value)
+            if self.echo:
+                log("{}", value)
+            if value.startswith('exit-'):
+                # Return the exit status.
+                return int(value[5:])
+
+
+@task
+def Invoke_Shard(*values):
+    """process values in shards under invoke()"""
+    invocation = invoke(["--jobs=2", "shard", "--echo"]+list(values))
+    for line in sorted(invocation.output.splitlines()):
+        log("{}", line)
+    log("status: {}", invocation.status)
+
+
+@lazy_setting
+def Probe(value=None):
+    """a setting initialized on first use"""
+    log("probing")
+    if value is None or value == '':
+        value = "default"
+    if value == "invalid":
+        raise ValueError("probe: expected a valid value; got %r" % value)
+    env.add(probe=value)
+
+
+@task
+def Use_Probe(reads="2"):
+    """read a lazy setting the given number of times"""
+    log("started")
+    for k in range(int(reads)):
+        log("probe: {}", env.probe)
+
+
+@task
+def Count_Items(count, total="", interval="10"):
+    """report the progress of counting items in threads"""
+    with progress("Counting", total=(int(total) if total else None),
+                  interval=float(interval)) as counter:
+        threads = [threading.Thread(target=counter.update)
+                   for k in range(int(count))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    # Ignored once the final state is displayed.
+    counter.update()
+    counter.close()
+
+
+@task
+def Write_Read(path, data=""):
+    """write a file atomically and map it back"""
+    write(path, data)
+    content = read(path)
+    try:
+        log("{}: {} bytes: \"{}\"", path, len(content),
+            content[:].decode("utf-8"))
+    finally:
+        content.close()
+
+
+@task
+def Watch_Once(root):
+    """wait for a file to change"""
+    mktree(root)
+    path = os.path.join(root, "changed.txt")
+    timer = threading.Timer(0.5, write, (path, "changed"))
+    timer.start()
+    try:
+        for changes in watch([root], delay=0.1):
+            # Temporary files of `write()` are gone by now.
+            log("changed: {}", ", ".join(path for path in changes
+                                         if os.path.exists(path)))
+            break
+    finally:
+        timer.join()
+
+
+@task
+def Run_Command(cmd):
+    """run a command and print its output"""
+    log("{}", pipe(cmd).decode("utf-8").rstrip("\n"))
+
+
+@task
+def Run_Exe(cmd):
+    """replace the process with a command"""
+    exe(cmd)
+
+
+@task
+def Read_Input():
+    """read a line from the standard input"""
+    log("{}", os.read(0, 1024).decode("utf-8").rstrip("\n"))
+
+
+@task
+def Spin(seconds):
+    """keep the CPU busy"""
+    deadline = time.time()+float(seconds)
+    count = 0
+    while time.time() < deadline:
+        count += 1
+
+
+@task
+def Allocate(size, where="self"):
+    """fill the given number of MiB of memory, then keep busy"""
+    size = int(size)*1024*1024
+    if where == "child":
+        sh([sys.executable, "-c", "b'x'*%d" % size])
+        return
+    ballast = b"x"*size
+    Spin(5)
+    log("not interrupted")
+
+
+@task
+class Make_Tree(object):
+    """create files given as name=content"""
+
+    root = argument()
+    specs = argument(plural=True)
+
+    def __init__(self, root, specs):
+        self.root = root
+        self.specs = specs
+
+    def __call__(self):
+        for spec in self.specs:
+            name, content = spec.split("=", 1)
+            path = os.path.join(self.root, name)
+            mktree(os.path.dirname(path))
+            write(path, content)
+
+
+@task
+def Digest_Tree(root):
+    """print digests of the files in a tree"""
+    tree, digests = digest(root)
+    log("{}: {}", root, tree)
+    for name in sorted(digests):
+        log("{}: {}", name, digests[name])
+
+
+@task
+def Show_Tree(root):
+    """list a directory tree with file content and modes"""
+    for dirpath, dirnames, filenames in sorted(os.walk(root)):
+        dirnames.sort()
+        for name in sorted(dirnames+filenames):
+            path = os.path.join(dirpath, name)
+            label = os.path.relpath(path, root)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                log("{} -> {}", label, os.readlink(path))
+            elif stat.S_ISDIR(st.st_mode):
+                log("{}/", label)
+            elif stat.S_ISREG(st.st_mode):
+                log("{} ({:o}): {}", label, stat.S_IMODE(st.st_mode),
+                    open(path).read())
+            else:
+                log("{}: special file", label)
+
+
+@task
+def Sync_Tree(src, dst, mode="update"):
+    """copy a tree incrementally"""
+    stats = sync(src, dst, checksum=(mode == "checksum"),
+                 delete=(mode == "delete"))
+    log("copied: {copied}, deleted: {deleted},"
+        " unchanged: {unchanged}, bytes: {bytes}", **stats)
+
+
+@task
+def Pack_Unpack(src, archive, dst):
+    """pack a tree and unpack the archive"""
+    pack(src, archive, quiet=True)
+    unpack(archive, dst, quiet=True)
+
+
+@task
+class Find_Paths(object):
+    """list paths that match +include and !exclude patterns"""
+
+    root = argument()
+    patterns = argument(plural=True, default=())
+
+    def __init__(self, root, patterns):
+        self.root = root
+        self.include = [pattern[1:] for pattern in patterns
+                        if pattern[0] == "+"]
+        self.exclude = [pattern[1:] for pattern in patterns
+                        if pattern[0] == "!"]
+
+    def __call__(self):
+        entries = find(self.root, include=self.include or None,
+                       exclude=self.exclude or ('.git',))
+        for entry in sorted(entries, key=(lambda entry: entry.path)):
+            log("{}{}", os.path.relpath(entry.path, self.root),
+                "/" if entry.is_dir() else "")
+
+
+@task
+def Session_Commands():
+    """run commands in one shell process"""
+    with session() as shell:
+        shell.sh("cd /; export WORD=exported")
+        log("{}", shell.pipe("echo ${WORD:-unset}; basename $PWD")
+                       .decode("utf-8").replace("\n", " ").strip())
+        log("{}", shell.pipe("echo $WORD", environ={'WORD': "environ"})
+                       .decode("utf-8").strip())
+        log("{}", shell.pipe("basename $PWD", cd="..")
+                       .decode("utf-8").strip())
+        log("{}", shell.pipe("tr a-z A-Z", data=b"data")
+                       .decode("utf-8").strip())
+        shell.sh("echo $$ > .session.pid")
+        pid = int(open(".session.pid").read())
+        os.unlink(".session.pid")
+        os.kill(pid, 9)
+        # Let the shell die before the next command.
+        time.sleep(0.2)
+        log("{}", shell.pipe("echo restarted").decode("utf-8").strip())
+        shell.sh("exit 3")
+
+
+@task
+def Run_Pipeline(*cmds):
+    """run commands connected with pipes"""
+    log("{}", pipeline(cmds).decode("utf-8").rstrip("\n"))
+
+
+@task
+def Pipeline_Modes(root):
+    """feed, redirect and stream a pipeline"""
+    mktree(root)
+    output = pipeline(["cat", "tr a-z A-Z"], data=b"input\n")
+    log("data: {}", output.decode("utf-8").rstrip("\n"))
+    output = pipeline([stage("pwd", cd=root), "xargs basename"])
+    log("cd: {}", output.decode("utf-8").rstrip("\n"))
+    output = pipeline([stage("sh -c 'echo $WORD'",
+                             environ={'WORD': "environ"}), "cat"])
+    log("environ: {}", output.decode("utf-8").rstrip("\n"))
+    path = os.path.join(root, "output.txt")
+    pipeline(["printf 'b\\na\\n'", "sort"], output=path)
+    log("output: {}", ", ".join(open(path).read().split()))
+    for line in pipeline(["seq 3", "sed s/^/line-/"], stream=True):
+        log("stream: {}", line.decode("utf-8").rstrip("\n"))
+    output = pipeline(["seq 100000", "head -1"])
+    log("sigpipe: {}", output.decode("utf-8").rstrip("\n"))
+    # The output goes either to a file or to the iterator.
+    pipeline(["seq 3"], output=path, stream=True)
+
+
+@task(lock='wait')
+def Lock_Wait(delay="1"):
+    """sleep holding the lock; concurrent runs wait"""
+    log("started")
+    time.sleep(float(delay))
+    log("finished")
+
+
+@task(lock='fail')
+def Lock_Fail(delay="1"):
+    """sleep holding the lock; concurrent runs fail"""
+    time.sleep(float(delay))
+    log("finished")
+
+
+@task
+def Resume_Steps(path):
+    """run steps, failing until the file exists"""
+    step("first", log, "first step")
+    step("second", _check_exists, path)
+    step("third", log, "third step")
+
+
+def _check_exists(path):
+    if not os.path.exists(path):
+        raise fail("missing {}", path)
+    log("second step")
+
+
+@task
+def Plan_Files(root, mode="run"):
+    """copy, move and remove files in a plan"""
+    with plan(dry_run=(mode == "dry-run")) as ops:
+        ops.mktree(os.path.join(root, "build/lib"))
+        ops.cp(os.path.join(root, "a.txt"),
+               os.path.join(root, "build/lib/a.txt"))
+        ops.mv(os.path.join(root, "b.txt"),
+               os.path.join(root, "build/b.txt"))
+        ops.rm(os.path.join(root, "c.txt"))
+        if mode == "fail":
+            ops.cp(os.path.join(root, "missing.txt"),
+                   os.path.join(root, "build/missing.txt"))
+
+
+def _exist(paths):
+    # Checks all the paths at once.
+    return [path if os.path.exists(path)
+            else ValueError("%s: not found" % path) for path in paths]
+
+
+def _upper(values):
+    return [value.upper() for value in values]
+
+
+@task
+class Check_Paths(object):
+    """check paths with batch validators"""
+
+    paths = argument(check=_exist, plural=True, batch=True)
+    tag = option(key='t', check=_upper, default=(), plural=True,
+                 batch=True, value_name='tag', hint="tag the paths")
+
+    def __init__(self, paths, tag):
+        self.paths = paths
+        self.tags = tag
+
+    def __call__(self):
+        for path in self.paths:
+            log("{} {}", path, " ".join(self.tags))
+
+
+
+@task
+def Scratch_Space(budget=None):
+    """write a file to a scratch workspace"""
+    if budget is not None:
+        budget = int(budget)
+    workspace = scratch(budget=budget)
+    try:
+        with workspace:
+            write(workspace.join("data"), "x"*65536)
+            log("exists: {}", os.path.exists(workspace.join("data")))
+            with scratch() as nested:
+                log("shared: {}", nested.root == workspace.root)
+            workspace.check()
+    finally:
+        # Even when the task fails.
+        if os.path.exists(workspace.root):
+            log("left behind: {}", workspace.root)
+    log("removed")